@@ -6,6 +6,9 @@ Obtain the pathway to a given event of interest from a Kappa simulation.
 """
 
 import os
+import re
+import hashlib
+import pickle
 import shutil
 import subprocess
 import warnings
@@ -17,10 +20,26 @@ import copy
 import textwrap
 import time
 import collections
+import concurrent.futures
+import functools
+import heapq
 import itertools
 import string
 
 
+# Kappa agent and site patterns, e.g. "A(x[1] y{p})" and "y[.]{u/p}".
+_AGENT_RE = re.compile(r"(?P<name>[^\s(),]+)\((?P<sites>[^)]*)\)")
+_SITE_RE = re.compile(r"(?P<name>[^\[{]*)"
+                      r"(?:\[(?P<binding>[^\]]*)\])?"
+                      r"(?:\{(?P<state>[^}]*)\})?"
+                      r"(?:\[(?P<binding2>[^\]]*)\])?")
+# Dot lines of edges drawn with a penwidth, e.g. "1 -> 2 [..., penwidth=3]".
+_EDGE_LINE_RE = re.compile(r"^(?=.*->)(?=.*penwidth).*$", re.MULTILINE)
+# Directory where parsed causal graphs are kept as pickles. Nothing is
+# cached while it is None, see enable_graph_cache.
+graph_cache_dir = None
+
+
 class EventNode(object):
     """
     An event node to use in causal graphs. It represents a specific event in
@@ -728,7 +747,48 @@ class CausalGraph(object):
         self.minrank = None
         self.prevcores = None
         if self.filename != None:
-            self.read_dot(self.filename)
+            # Parsed graphs are kept as pickles only when asked for.
+            if graph_cache_dir != None:
+                self.read_dot_cached(self.filename)
+            else:
+                self.read_dot(self.filename)
+
+
+    def read_dot_cached(self, dotpath):
+        """
+        Read the graph from the pickle saved in graph_cache_dir by an earlier
+        reading of the same dot file, otherwise read the dot file and save
+        its pickle. A pickle is used only if the dot file and its state file
+        have the same modification time and size, and the graph the same
+        initial attributes, as when the pickle was saved.
+        """
+
+        dot_stat = os.stat(dotpath)
+        try:
+            state_stat = os.stat(get_statefile_path(dotpath))
+            state_key = (state_stat.st_mtime_ns, state_stat.st_size)
+        except OSError:
+            state_key = None
+        cache_key = (dot_stat.st_mtime_ns, dot_stat.st_size, state_key,
+                     self.eoi, self.hypergraph, self.producedby,
+                     self.showintro, self.precedenceonly, self.rankposdict)
+        pickle_path = get_graph_cache_path(dotpath)
+        # Any problem with the pickle only means that the dot file is read.
+        try:
+            with open(pickle_path, "rb") as pickle_file:
+                saved_key, saved_state = pickle.load(pickle_file)
+            if saved_key == cache_key:
+                self.__dict__.update(saved_state)
+                return
+        except Exception:
+            pass
+        self.read_dot(dotpath)
+        try:
+            with open(pickle_path, "wb") as pickle_file:
+                pickle.dump((cache_key, self.__dict__), pickle_file,
+                            pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            uncache_graph(dotpath)
 
 
     #def read_dualstory(self, dotpath):
@@ -1039,12 +1099,7 @@ class CausalGraph(object):
         """ Read node states from separate json file. """
 
         if len(self.statenodes) > 0:
-            dash = self.filename.rfind("-")
-            period = self.filename.rfind(".")
-            slash = self.filename.rfind("/")
-            num = self.filename[dash+1:period]
-            prefix = self.filename[:slash]
-            json_path = "{}/statefile-{}.json".format(prefix, num)
+            json_path = get_statefile_path(self.filename)
             statefile = open(json_path, "r")
             statedict = json.load(statefile)
             for statenode in self.statenodes:
@@ -1336,21 +1391,29 @@ class CausalGraph(object):
                 current_nodes.append(node)
             else:
                 node.rank = None
+        # Index hyperedges and their targets by source. Hyperedges do not
+        # change while ranking, so this is done only once.
+        source_hedges = {}
+        out_targets = {}
+        for hyperedge in self.hyperedges:
+            for source in hyperedge.sources:
+                source_hedges.setdefault(source, set()).add(hyperedge)
+                out_targets.setdefault(source, {})[hyperedge.target] = None
         while len(current_nodes) > 0:
             # 1) Gather hyperedges that have a current_node in their sources.
+            current_set = set()
+            for current_node in current_nodes:
+                current_set.update(source_hedges.get(current_node, []))
             current_hyperedges = []
             for hyperedge in self.hyperedges:
-                for current_node in current_nodes:
-                    if current_node in hyperedge.sources:
-                        if hyperedge not in current_hyperedges:
-                            current_hyperedges.append(hyperedge)
+                if hyperedge in current_set:
+                    current_hyperedges.append(hyperedge)
             # 2) Gather candidate nodes as any target of current meshes
             #    that is not ranked yet.
-            candidate_nodes = []
+            candidate_nodes = {}
             for hyperedge in current_hyperedges:
                 if hyperedge.target.rank == None:
-                    if hyperedge.target not in candidate_nodes:
-                        candidate_nodes.append(hyperedge.target)
+                    candidate_nodes[hyperedge.target] = None
             # 3) Set rank of all candidate nodes that are secured: all the
             #    nodes pointing to them (ignoring intro nodes) are already
             #    ranked in at least one edge group.
@@ -1427,18 +1490,10 @@ class CausalGraph(object):
             #    have their target already ranked.
             next_nodes = []
             for current_node in current_nodes:
-                keep_node = False
-                target_nodes = []
-                for hyperedge in self.hyperedges:
-                    if current_node in hyperedge.sources:
-                        if hyperedge.target not in target_nodes:
-                            target_nodes.append(hyperedge.target)
-                for target_node in target_nodes:
+                for target_node in out_targets.get(current_node, []):
                     if target_node.rank == None:
-                        keep_node = True
+                        next_nodes.append(current_node)
                         break
-                if keep_node == True:
-                    next_nodes.append(current_node)
             current_nodes = next_nodes
         # Rank intro nodes at 0 if top is selected.
         for node in self.eventnodes:
@@ -1449,14 +1504,13 @@ class CausalGraph(object):
             for node in self.eventnodes:
                 if node.intro == True:
                     target_ranks = []
-                    for hyperedge in self.hyperedges:
-                        if node in hyperedge.sources:
-                            if hyperedge.target.shrink == False:
-                                target_ranks.append(hyperedge.target.rank)
-                            else:
-                                for h2 in self.hyperedges:
-                                    if hyperedge.target in h2.sources:
-                                        target_ranks.append(h2.target.rank)
+                    for hyperedge in source_hedges.get(node, []):
+                        if hyperedge.target.shrink == False:
+                            target_ranks.append(hyperedge.target.rank)
+                        else:
+                            for target in out_targets.get(hyperedge.target,
+                                                          []):
+                                target_ranks.append(target.rank)
                     node.rank = min(target_ranks) - 1
         # Optionally, push targets of intro nodes down when possible.
         # This way of doing it does not work very well. Takes a long time on
@@ -3290,28 +3344,9 @@ def same_objects(list1, list2):
     (The objects may be found in a different order in the two lists).
     """
 
-    group1 = list1.copy()
-    group2 = list2.copy()
-    found1 = []
-    found2 = []
-    for i in range(len(group1)):
-        for object2 in group2:
-            if group1[i] == object2:
-                found1.insert(0, i)
-                break
-    for j in range(len(group2)):
-        for object1 in group1:
-            if group2[j] == object1:
-                found2.insert(0, j)
-                break
-    for i in found1:
-        del(group1[i])
-    for j in found2:
-        del(group2[j])
-    if len(group1) == 0 and len(group2) == 0:
-        are_same = True
-    else:
-        are_same = False
+    # Objects are compared by identity, so comparing them as sets gives
+    # the same answer as matching them in both directions.
+    are_same = set(list1) == set(list2)
 
     return are_same
 
@@ -3395,6 +3430,37 @@ def getcausalcores(eoi, kappamodel, kasimpath, kaflowpath,
     run_kaflow(eoi, trace_path, kaflowpath, precedenceonly, ignorelist)
 
 
+def getcausalcoresbatch(eoi, kappamodel, kasimpath, kaflowpath,
+                        simtime=1000, simseeds=[1], precedenceonly=True,
+                        ignorelist=[], eoi_def=None):
+    """
+    Generate initial causal cores of given event of interest from one KaSim
+    simulation per seed. The simulations run in parallel and KaFlow is run
+    on each trace, the causal cores are numbered one after the other.
+    """
+
+    new_model = add_eoi(eoi, kappamodel, eoi_def)
+    # Each simulation is run by its own KaSim process, threads are enough
+    # to wait on them in parallel.
+    workers = max(1, min(len(simseeds), os.cpu_count() or 1))
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    futures = []
+    for simseed in simseeds:
+        futures.append(executor.submit(run_kasim, new_model, kasimpath,
+                                       simtime, simseed,
+                                       "-seed{}".format(simseed)))
+    # Run KaFlow on each trace as soon as it is ready, in the order of the
+    # seeds, while the other simulations keep running.
+    filenum = 1
+    try:
+        for future in futures:
+            trace_path = future.result()
+            filenum = run_kaflow(eoi, trace_path, kaflowpath, precedenceonly,
+                                 ignorelist, filenum)
+    finally:
+        executor.shutdown()
+
+
 def getstories(eoi, kappamodel, kasimpath, kastorpath,
                simtime=1000, simseed=None, compression=None, eoi_def=None):
     """
@@ -3410,33 +3476,35 @@ def getstories(eoi, kappamodel, kasimpath, kastorpath,
 def add_eoi(eoi, kappamodel, eoi_def=None):
     """ Create a new Kappa model where the EOI is added. """
 
-    if not os.path.exists(eoi):
-        os.mkdir(eoi)
-    if not os.path.exists("{}/tmp".format(eoi)):
-        os.mkdir("{}/tmp".format(eoi))
-    if not os.path.exists("{}/unique".format(eoi)):
-        os.mkdir("{}/unique".format(eoi))
+    os.makedirs("{}/tmp".format(eoi), exist_ok=True)
+    os.makedirs("{}/unique".format(eoi), exist_ok=True)
     last_dot = kappamodel.rfind(".")
     prefix = kappamodel[:last_dot]
     new_path = "{}/{}-eoi.ka".format(eoi, prefix)
-    shutil.copyfile(kappamodel, new_path)
-    new_file = open(new_path, "a")
+    # Copy the model and add the EOI lines while the new file is open.
+    added_lines = ""
     if eoi_def != None:
-        new_file.write("%obs: '{}' {}\n".format(eoi, eoi_def))
-    new_file.write("%mod: [true] do $TRACK '{}' [true];\n".format(eoi))
+        added_lines += "%obs: '{}' {}\n".format(eoi, eoi_def)
+    added_lines += "%mod: [true] do $TRACK '{}' [true];\n".format(eoi)
     ## Ask for DIN.
     #din_file = "{}/din.json".format(eoi)
-    #new_file.write('\n%mod: [true] do $DIN "{}" [true];\n'.format(din_file))
-    new_file.close()
+    #added_lines += '\n%mod: [true] do $DIN "{}" [true];\n'.format(din_file)
+    with open(kappamodel, "rb") as model_file:
+        with open(new_path, "wb") as new_file:
+            shutil.copyfileobj(model_file, new_file, 1024*1024)
+            new_file.write(added_lines.encode())
     
     return new_path
 
 
-def run_kasim(kappa_with_eoi, kasimpath, simtime, simseed):
-    """ Run simulation with added EOI to produce trace. """
+def run_kasim(kappa_with_eoi, kasimpath, simtime, simseed, suffix=""):
+    """
+    Run simulation with added EOI to produce trace. The suffix is added to
+    the names of the output files, to keep simulations apart.
+    """
 
     last_dot = kappa_with_eoi.rfind(".")
-    prefix = kappa_with_eoi[:last_dot]
+    prefix = "{}{}".format(kappa_with_eoi[:last_dot], suffix)
     output_path = "{}.csv".format(prefix)
     trace_path = "{}.json".format(prefix)
     if simtime <= 100:
@@ -3464,20 +3532,29 @@ def run_kasim(kappa_with_eoi, kasimpath, simtime, simseed):
     return trace_path
 
 
-def run_kaflow(eoi, trace_path, kaflowpath, precedenceonly, ignorelist):
-    """ Run KaFlow on the trace containing the EOI. """
+def run_kaflow(eoi, trace_path, kaflowpath, precedenceonly, ignorelist,
+               filenum=1):
+    """
+    Run KaFlow on the trace containing the EOI. The causal cores kept are
+    numbered from filenum, return the next free number.
+    """
 
+    # KaFlow writes its raw cores apart from the numbered causal cores,
+    # which may already contain the cores from other traces. Cores left
+    # by a previous run are removed first so they do not mix with new ones.
+    remove_dot_files("{}/tmp".format(eoi), "kaflowcore")
+    if filenum == 1:
+        remove_dot_files("{}/tmp".format(eoi), "causalcore")
     if precedenceonly == True:
         subprocess.run(("{}".format(kaflowpath),
                         "--precedence-only",
-                        "-o", "{}/tmp/causalcore-".format(eoi),
+                        "-o", "{}/tmp/kaflowcore-".format(eoi),
                         "{}".format(trace_path)))
     elif precedenceonly == False:
         subprocess.run(("{}".format(kaflowpath),
-                        "-o", "{}/tmp/causalcore-".format(eoi),
+                        "-o", "{}/tmp/kaflowcore-".format(eoi),
                         "{}".format(trace_path)))
-    core_files = get_dot_files("{}/tmp".format(eoi), "causalcore")
-    filenum = 1
+    core_files = get_dot_files("{}/tmp".format(eoi), "kaflowcore")
     nignored = 0
     for core_file in core_files:
         input_path = "{}/tmp/{}".format(eoi, core_file)
@@ -3486,18 +3563,83 @@ def run_kaflow(eoi, trace_path, kaflowpath, precedenceonly, ignorelist):
         contains_ignored = check_ignored(eoi, input_path, ignorelist)
         input_file.close()
         os.remove(input_path)
+        uncache_graph(input_path)
         if contains_ignored == True:
             nignored += 1
         elif contains_ignored == False:
             content.insert(1, '  precedenceonly="{}"\n'.format(precedenceonly))
             content.insert(1, '  producedby="KaFlow"\n')
-            output_file = open("{}/tmp/causalcore-{}.dot".format(eoi, filenum), "w")
+            output_path = "{}/tmp/causalcore-{}.dot".format(eoi, filenum)
+            uncache_graph(output_path)
+            output_file = open(output_path, "w")
             output_file.writelines(content)
             output_file.close()
             filenum += 1
     print("Ignoring {} cores out of {} because they contain undo rules."
         .format(nignored, len(core_files)))
 
+    return filenum
+
+
+def remove_dot_files(directory, prefix):
+    """ Remove the numbered dot files with given prefix from a directory. """
+
+    for dot_file in get_dot_files(directory, prefix):
+        dot_path = "{}/{}".format(directory, dot_file)
+        os.remove(dot_path)
+        uncache_graph(dot_path)
+
+
+def get_statefile_path(dotpath):
+    """ Get the path of the json file holding the states of a dot file. """
+
+    dash = dotpath.rfind("-")
+    period = dotpath.rfind(".")
+    slash = dotpath.rfind("/")
+    num = dotpath[dash+1:period]
+    prefix = dotpath[:slash]
+
+    return "{}/statefile-{}.json".format(prefix, num)
+
+
+def enable_graph_cache(cache_dir):
+    """
+    Keep the causal graphs read from dot files as pickles in cache_dir for
+    the rest of the run, so that reading the same unchanged file again is
+    faster. cache_dir should only ever contain pickles written by this
+    module, as loading a pickle can run arbitrary code.
+    """
+
+    global graph_cache_dir
+    os.makedirs(cache_dir, exist_ok=True)
+    graph_cache_dir = cache_dir
+
+
+def disable_graph_cache():
+    """ Stop caching causal graphs, the pickles already saved are kept. """
+
+    global graph_cache_dir
+    graph_cache_dir = None
+
+
+def get_graph_cache_path(dotpath):
+    """ Get the path of the pickle that caches the graph of a dot file. """
+
+    abs_path = os.path.abspath(dotpath)
+    digest = hashlib.sha1(abs_path.encode()).hexdigest()
+
+    return "{}/{}.pkl".format(graph_cache_dir, digest)
+
+
+def uncache_graph(dotpath):
+    """ Remove the cached graph of a dot file if caching is on. """
+
+    if graph_cache_dir != None:
+        try:
+            os.remove(get_graph_cache_path(dotpath))
+        except FileNotFoundError:
+            pass
+
 
 def check_ignored(eoi, input_path, ignorelist):
     """
@@ -3574,7 +3716,9 @@ def fillsiphon(eoi, kappamodel, kastorpath):
         tracefile.close()
         # Get story with fill siphon from core trace using KaStor.
         subprocess.run(("{}".format(kastorpath), "--none", "{}".format(trace_path)))
-        os.rename("cflow_none_0.dot", "{}/tmp/siphon-{}.dot".format(eoi, filenumber))
+        siphon_path = "{}/tmp/siphon-{}.dot".format(eoi, filenumber)
+        uncache_graph(siphon_path)
+        os.rename("cflow_none_0.dot", siphon_path)
         os.remove("cflow_none_Summary.dat")
         # Using weak compression here will sometimes remove loop events.
         #subprocess.run(("{}".format(kastorpath), "--weak", "{}".format(trace_path)))
@@ -6601,10 +6745,11 @@ def mergedualstories(eoi, prefix, causalgraphs=None, siphon=False, showintro=Tru
                      addedgelabels=False, showedgelabels=False, edgeid=True,
                      edgeocc=False, edgeprob=False, statstype="abs",
                      weightedges=False, color=True, writedot=True,
-                     rmprev=False, msg=True):
+                     rmprev=False, msg=True, topk=None):
     """
     Merge equivalent dual stories into a unique dual story while counting
-    occurrence.
+    occurrence. If topk is given, only the topk most frequent unique
+    stories are kept.
     """
 
     # Reading section.
@@ -6618,43 +6763,27 @@ def mergedualstories(eoi, prefix, causalgraphs=None, siphon=False, showintro=Tru
         stories = causalgraphs
         story_files = None
     # Doing the work.
+    # Only stories with the same fingerprint can be equivalent. Group the
+    # stories by fingerprint, in order of first appearance, and merge each
+    # group on its own.
+    fingerprint_groups = {}
+    for story in stories:
+        fingerprint = graph_fingerprint(story, True)
+        if fingerprint not in fingerprint_groups:
+            fingerprint_groups[fingerprint] = []
+        fingerprint_groups[fingerprint].append(story)
     merged_stories = []
-    while len(stories) > 0:
-        current_story = stories[0]
-        equivalent_list = [0]
-        for i in range(1, len(stories)):
-            same_story, ev, st, equi_edges = equivalent_graphs(current_story,
-                                                               stories[i],
-                                                               True, True)
-            if same_story == True:
-                equivalent_list.insert(0, i)
-                current_story.occurrence += stories[i].occurrence
-                for j in range(len(current_story.hyperedges)):
-                    equi_index = equi_edges[j]
-                    weight = stories[i].hyperedges[equi_index].weight
-                    current_story.hyperedges[j].weight += weight
-        # Find the original dual stories from which each unique
-        # story comes from.
-        original_stories = []
-        for index in equivalent_list:
-            file_name = stories[index].filename
-            dash = file_name.rfind("-")
-            period = file_name.rfind(".")
-            #if "_node" in file_name:
-            #    underscore = file_name.index("_node")
-            #    previd = file_name[:period]
-            #else:
-            previd = file_name[dash+1:period]
-            original_stories.append(previd)
-        current_story.prevcores = original_stories
-        merged_stories.append(current_story)
-        for i in equivalent_list:
-            del(stories[i])
+    for group in fingerprint_groups.values():
+        merged_stories += merge_story_group(group)
         #for i in range(len(analogous_list)-1, -1, -1):
         #    index = analogous_list[i]
         #    del(stories[index])
-    sorted_stories = sorted(merged_stories, key=lambda x: x.occurrence,
-                            reverse=True)
+    if topk == None:
+        sorted_stories = sorted(merged_stories, key=lambda x: x.occurrence,
+                                reverse=True)
+    else:
+        sorted_stories = heapq.nlargest(topk, merged_stories,
+                                        key=lambda x: x.occurrence)
     # Propagate new hyperedge weights to their edge lists.
     for story in sorted_stories:
         for hyperedge in story.hyperedges:
@@ -6694,30 +6823,78 @@ def mergedualstories(eoi, prefix, causalgraphs=None, siphon=False, showintro=Tru
 def get_dot_files(eoi, prefix=None):
     """ Get the number of the first and last stories. """
 
-    tmp_file_list = os.listdir("{}".format(eoi))
     file_list = []
-    for file_name in tmp_file_list:
-        if "dot" in file_name:
-            if prefix == None:
-                file_list.append(file_name)
-            else:
-                dash = file_name.rfind("-")
-                if file_name[:dash] == prefix:
-                    file_list.append(file_name)
-    file_dicts = []
+    with os.scandir("{}".format(eoi)) as entries:
+        for entry in entries:
+            if "dot" in entry.name:
+                if prefix == None:
+                    file_list.append(entry.name)
+                else:
+                    dash = entry.name.rfind("-")
+                    if entry.name[:dash] == prefix:
+                        file_list.append(entry.name)
+    numbered_files = []
     for file_name in file_list:
         dash = file_name.rfind("-")
         period = file_name.rfind(".")
         number = int(file_name[dash+1:period])
-        file_dicts.append({"file": file_name, "num": number})
-    sorted_dicts = sorted(file_dicts, key=lambda x: x["num"])
+        numbered_files.append((number, file_name))
+    numbered_files.sort(key=lambda x: x[0])
     sorted_list = []
-    for d in sorted_dicts:
-        sorted_list.append(d["file"])
+    for number, file_name in numbered_files:
+        sorted_list.append(file_name)
 
     return sorted_list
 
 
+def merge_story_group(stories):
+    """
+    Merge the equivalent stories from a list of stories. The first story of
+    each set of equivalent stories accumulates the occurrence and hyperedge
+    weights of the others. Return the list of merged stories.
+    """
+
+    merged_stories = []
+    # Indexes of the stories already merged into a previous story.
+    consumed = set()
+    for start in range(len(stories)):
+        if start in consumed:
+            continue
+        current_story = stories[start]
+        equivalent_list = [start]
+        for i in range(start+1, len(stories)):
+            if i in consumed:
+                continue
+            same_story, ev, st, equi_edges = equivalent_graphs(current_story,
+                                                               stories[i],
+                                                               True, True)
+            if same_story == True:
+                equivalent_list.insert(0, i)
+                consumed.add(i)
+                current_story.occurrence += stories[i].occurrence
+                for j in range(len(current_story.hyperedges)):
+                    equi_index = equi_edges[j]
+                    weight = stories[i].hyperedges[equi_index].weight
+                    current_story.hyperedges[j].weight += weight
+        # Find the original dual stories from which each unique
+        # story comes from.
+        original_stories = []
+        for index in equivalent_list:
+            file_name = stories[index].filename
+            dash = file_name.rfind("-")
+            period = file_name.rfind(".")
+            #if "_node" in file_name:
+            #    underscore = file_name.index("_node")
+            #    previd = file_name[:period]
+            #else:
+            previd = file_name[dash+1:period]
+            original_stories.append(previd)
+        current_story.prevcores = original_stories
+        merged_stories.append(current_story)
+
+    return merged_stories
+
+
 def equivalent_graphs(graph1, graph2, enforcerank=True,
                       return_correspondances=False):
     """
@@ -6725,7 +6902,22 @@ def equivalent_graphs(graph1, graph2, enforcerank=True,
     hyperedges.
     """
 
-    corr_st, corr_ed = [], []
+    corr_ev, corr_st, corr_ed = [], [], []
+    # Graphs with different numbers of nodes or hyperedges cannot be
+    # equivalent, no need to match their elements.
+    same_sizes = True
+    if len(graph1.eventnodes) != len(graph2.eventnodes):
+        same_sizes = False
+    elif len(graph1.statenodes) != len(graph2.statenodes):
+        same_sizes = False
+    elif len(graph1.hyperedges) != len(graph2.hyperedges):
+        same_sizes = False
+    if same_sizes == False:
+        if return_correspondances == False:
+            return False
+        elif return_correspondances == True:
+            return False, corr_ev, corr_st, corr_ed
+
     equi_events, corr_ev = equivalent_node_lists(graph1.eventnodes,
                                                  graph2.eventnodes,
                                                  enforcerank, True)
@@ -6748,6 +6940,29 @@ def equivalent_graphs(graph1, graph2, enforcerank=True,
         return are_equivalent, corr_ev, corr_st, corr_ed
 
 
+def graph_fingerprint(graph, enforcerank=True):
+    """
+    Summarize a graph as the counts of the keys of its event nodes, state
+    nodes and hyperedges. Two graphs are equivalent exactly when their
+    fingerprints are the same.
+    """
+
+    event_keys = collections.Counter()
+    for eventnode in graph.eventnodes:
+        event_keys[node_key(eventnode, enforcerank)] += 1
+    state_keys = collections.Counter()
+    for statenode in graph.statenodes:
+        state_keys[node_key(statenode, enforcerank)] += 1
+    hyperedge_keys = collections.Counter()
+    for hyperedge in graph.hyperedges:
+        hyperedge_keys[hyperedge_key(hyperedge, enforcerank)] += 1
+    fingerprint = (frozenset(event_keys.items()),
+                   frozenset(state_keys.items()),
+                   frozenset(hyperedge_keys.items()))
+
+    return fingerprint
+
+
 def equivalent_hyperedge_lists(edgelist1, edgelist2, enforcerank=True,
                                return_correspondances=False):
     """
@@ -6755,25 +6970,24 @@ def equivalent_hyperedge_lists(edgelist1, edgelist2, enforcerank=True,
     with same labels).
     """
 
+    # Equivalent hyperedges share the same key, which counts the keys of
+    # their sources. Bucket the indexes of list2 by key so that each
+    # hyperedge from list1 takes the first unused index with its key.
+    buckets = {}
+    for i in range(len(edgelist2)):
+        key = hyperedge_key(edgelist2[i], enforcerank)
+        if key not in buckets:
+            buckets[key] = collections.deque()
+        buckets[key].append(i)
     are_equivalent = True
     correspondances = []
-    list2_indexes = list(range(len(edgelist2)))
     for hyperedge1 in edgelist1:
-        equi_edges = False
-        for i in list2_indexes:
-            hyperedge2 = edgelist2[i]
-            equi_edges = equivalent_hyperedges(hyperedge1, hyperedge2,
-                                               enforcerank)
-            if equi_edges == True:
-                correspondances.append(i)
-                list2_indexes.remove(i)
-                break
-        # If the previous loop finished with the last hyperedge from list2
-        # still not being equivalent.
-        if equi_edges == False:
+        indexes = buckets.get(hyperedge_key(hyperedge1, enforcerank))
+        if indexes == None or len(indexes) == 0:
             are_equivalent = False
             break
-    if len(list2_indexes) > 0:
+        correspondances.append(indexes.popleft())
+    if len(correspondances) < len(edgelist2):
         are_equivalent = False
 
     if return_correspondances == False:
@@ -6799,11 +7013,11 @@ def equivalent_hyperedges(hyperedge1, hyperedge2, enforcerank=True,
         hyperedge2_sources = hyperedge2.sources
     elif disregard_duplicates == True:
         hyperedge2_sources = []
-        seen_labels = []
+        seen_labels = set()
         for source in hyperedge2.sources:
             if source.label not in seen_labels:
                 hyperedge2_sources.append(source)
-                seen_labels.append(source.label)
+                seen_labels.add(source.label)
 
     equi_srcs, corr_srcs = equivalent_node_lists(hyperedge1.sources,
                                                  hyperedge2_sources,
@@ -6820,6 +7034,22 @@ def equivalent_hyperedges(hyperedge1, hyperedge2, enforcerank=True,
     
 
 
+def hyperedge_key(hyperedge, enforcerank=True):
+    """
+    Return a key that is the same for two hyperedges exactly when
+    equivalent_hyperedges finds them equivalent (without disregarding
+    duplicate sources).
+    """
+
+    source_keys = collections.Counter()
+    for source in hyperedge.sources:
+        source_keys[node_key(source, enforcerank)] += 1
+    key = (node_key(hyperedge.target, enforcerank),
+           frozenset(source_keys.items()))
+
+    return key
+
+
 def equivalent_node_lists(nodelist1, nodelist2, enforcerank=True,
                           return_correspondances=False):
     """
@@ -6831,24 +7061,24 @@ def equivalent_node_lists(nodelist1, nodelist2, enforcerank=True,
     gives the index of the corresponding element in list2.
     """
 
+    # Equivalent nodes share the same key. Bucket the indexes of list2 by
+    # key so that each node from list1 takes the first unused index with
+    # its key.
+    buckets = {}
+    for i in range(len(nodelist2)):
+        key = node_key(nodelist2[i], enforcerank)
+        if key not in buckets:
+            buckets[key] = collections.deque()
+        buckets[key].append(i)
     are_equivalent = True
     correspondances = []
-    list2_indexes = list(range(len(nodelist2)))
     for node1 in nodelist1:
-        equi_nodes = False
-        for i in list2_indexes:
-            node2 = nodelist2[i]
-            equi_nodes = equivalent_nodes(node1, node2, enforcerank)
-            if equi_nodes == True:
-                correspondances.append(i)
-                list2_indexes.remove(i)
-                break
-        # If the previous loop finished with the last node from list2
-        # still not being equivalent.
-        if equi_nodes == False:
+        indexes = buckets.get(node_key(node1, enforcerank))
+        if indexes == None or len(indexes) == 0:
             are_equivalent = False
             break
-    if len(list2_indexes) > 0:
+        correspondances.append(indexes.popleft())
+    if len(correspondances) < len(nodelist2):
         are_equivalent = False
 
     if return_correspondances == False:
@@ -6857,6 +7087,20 @@ def equivalent_node_lists(nodelist1, nodelist2, enforcerank=True,
         return are_equivalent, correspondances
 
 
+def node_key(node, enforcerank=True):
+    """
+    Return a key that is the same for two nodes exactly when equivalent_nodes
+    finds them equivalent.
+    """
+
+    if enforcerank == True:
+        key = (node.label, node.rank)
+    else:
+        key = node.label
+
+    return key
+
+
 def equivalent_nodes(node1, node2, enforcerank=True):
     """
     Find whether two nodes have the same label and optionally are at the same
@@ -8418,26 +8662,26 @@ def foldstory(story, fusedges=True):
                     break
         hyperedge.update()
     # Fuse hyperedges that are identical.
+    # Equivalent hyperedges share the same key, so each hyperedge is fused
+    # into the first hyperedge found with its key.
     if fusedges == True:
-        pair_found = True
-        while pair_found == True:
-            pair_found = False
-            for i in range(len(story.hyperedges)):
-                for j in range(i+1, len(story.hyperedges)):
-                    are_equi, corr = equivalent_hyperedges(story.hyperedges[i],
-                                                           story.hyperedges[j],
-                                                           False, True)
-                    if are_equi == True:
-                        for k in range(len(story.hyperedges[i].edgelist)):
-                            main_edge = story.hyperedges[i].edgelist[k]
-                            other_edge = story.hyperedges[j].edgelist[corr[k]]
-                            main_edge.weight += other_edge.weight
-                            main_edge.number += other_edge.number
-                        del(story.hyperedges[j])
-                        pair_found = True
-                        break
-                if pair_found == True:
-                    break
+        first_hyperedges = {}
+        kept_hyperedges = []
+        for hyperedge in story.hyperedges:
+            key = hyperedge_key(hyperedge, False)
+            main_hyperedge = first_hyperedges.get(key)
+            if main_hyperedge == None:
+                first_hyperedges[key] = hyperedge
+                kept_hyperedges.append(hyperedge)
+                continue
+            are_equi, corr = equivalent_hyperedges(main_hyperedge, hyperedge,
+                                                   False, True)
+            for k in range(len(main_hyperedge.edgelist)):
+                main_edge = main_hyperedge.edgelist[k]
+                other_edge = hyperedge.edgelist[corr[k]]
+                main_edge.weight += other_edge.weight
+                main_edge.number += other_edge.number
+        story.hyperedges[:] = kept_hyperedges
     for hyperedge in story.hyperedges:
         hyperedge.update()
 
@@ -8672,25 +8916,29 @@ def flush_ignored(graph_list, graph_files, ignorelist, msg=True):
     """
 
     init_len = len(graph_list)
-    graphs_to_remove = []
-    for i in range(len(graph_list)):
-        graph = graph_list[i]
+    # Keep the graphs to keep in a single pass instead of deleting the
+    # others one by one.
+    kept_graphs = []
+    removed_files = set()
+    for graph in graph_list:
         remove_graph = False
         for node in graph.eventnodes:
             if any(ignorestr in node.label for ignorestr in ignorelist):
                 remove_graph = True
                 break
-        if remove_graph == True:
-            graphs_to_remove.insert(0, i)
-    for i in graphs_to_remove:
-        if graph_files != None:
-           slash = graph_list[i].filename.index("/")
-           fname = graph_list[i].filename[slash+1:]
-           graph_files.remove(fname)
-        del(graph_list[i])
+        if remove_graph == False:
+            kept_graphs.append(graph)
+        elif graph_files != None:
+            slash = graph.filename.index("/")
+            removed_files.add(graph.filename[slash+1:])
+    n_removed = init_len - len(kept_graphs)
+    graph_list[:] = kept_graphs
+    if graph_files != None:
+        graph_files[:] = [fname for fname in graph_files
+                          if fname not in removed_files]
     if msg == True:
         print("Ignoring {} cores out of {} because they contain reverse rules."
-              .format(len(graphs_to_remove), init_len))
+              .format(n_removed, init_len))
 
 
 def add_mesh(graph, mesh, startid, insertpos=None):
@@ -8950,6 +9198,7 @@ def simplifypathway(eoi, causalgraphs=None, threshold=0.2, edgelabels=False,
         for path_file in path_files:
             file_path = "{}/{}".format(eoi, path_file)
             os.remove(file_path)
+            uncache_graph(file_path)
 
     return pathway        
 
@@ -9106,6 +9355,7 @@ def mapcores(eoi, causalgraphs=None, template=None, ignorelist=[],
         for path_file in path_files:
             file_path = "{}/{}".format(eoi, path_file)
             os.remove(file_path)
+            uncache_graph(file_path)
 
     return mappedcores
 
@@ -9833,14 +10083,14 @@ def change_intro_species(graph):
                 if n_ag == t_ag and n_site == t_site:
                     if n_bnd == None and t_bnd == None: # This is a state.
                         new_lbl = "{}({}{{{}}})".format(t_ag, t_site, t_state)
-                        node.species["state"] = t_state
+                        node.species = dict(node.species, state=t_state)
                     if n_state == None and t_state == None: # This is a bind.
                         new_lbl = "{}({}".format(t_ag, t_site)
                         if t_bnd == ".":
                             new_lbl += "[.]"
                         new_lbl += ")"
-                        node.species["bound_agent"] = t_bnd
-                        node.species["bound_site"] = req["bound_site"]
+                        node.species = dict(node.species, bound_agent=t_bnd,
+                                            bound_site=req["bound_site"])
             node.label = new_lbl
 
 
@@ -9859,10 +10109,12 @@ def build_species_graph(eoi, graph, edge_list):
             found_as_source = False
             found_as_target = False
             for edge in edge_list:
-                if edge.source == species_node:
+                if edge.source is species_node:
                     found_as_source = True
-                if edge.target == species_node:
+                if edge.target is species_node:
                     found_as_target = True
+                if found_as_source == True and found_as_target == True:
+                    break
             if species_node.intro == True and found_as_source == True:
                 include_node = True
             elif species_node.label == eoi and found_as_target == True:
@@ -9873,9 +10125,10 @@ def build_species_graph(eoi, graph, edge_list):
                 include_node = False
             if include_node == True:
                 species_pathway.nodes.append(species_node)
+    node_set = set(species_pathway.nodes)
     final_edges = []
     for edge in edge_list:
-        if edge.target in species_pathway.nodes:
+        if edge.target in node_set:
             final_edges.append(edge)
     species_pathway.edges = final_edges
 
@@ -9947,13 +10200,16 @@ def build_species_and_edges(graph):
 
 
 def get_init_species(graph):
-    """ Create a list of all initial species. """
+    """
+    Create a list of all initial species. The species are not copied,
+    functions that change the species of a node must replace its dict
+    instead of modifying it.
+    """
 
     init_species = []
     for node in graph.nodes:
         if node.intro == True:
-            for res in node.res_species:
-                init_species.append(res.copy())
+            init_species.extend(node.res_species)
 
     return init_species
 
@@ -10110,17 +10366,19 @@ def get_req_res(eoi, graph):
     the associated rule.
     """
 
+    parsed_rules = {}
     for event_node in graph.nodes:
         req_species = []
         res_species = []
-        species_list = build_species(event_node.rule)
+        # Nodes with the same rule share the species parsed from it.
+        if event_node.rule not in parsed_rules:
+            parsed_rules[event_node.rule] = build_species(event_node.rule)
+        species_list = parsed_rules[event_node.rule]
         for species in species_list:
             for char in ["binding", "state"]:
                 if species[char] != None:
                     if "/" in species[char]:
-                        slash = species[char].index("/")
-                        before = species[char][:slash]
-                        after = species[char][slash+1:]
+                        before, _, after = species[char].partition("/")
                         before_species = species.copy()
                         after_species = species.copy()
                         before_species[char] = before
@@ -10165,34 +10423,15 @@ def build_species(rule_str):
     """
 
     species_list = []
-    agents_list = []
-    ag_tmp = rule_str.split(",")
-    for ag in ag_tmp:
-        agents_list.append(ag.strip())
-    for agent in agents_list:
-        par = agent.index("(")
-        agent_name = agent[:par]
-        sites_list = agent[par+1:-1].split()
-        for site in sites_list:
-            open_bracket = 10000
-            open_curl = 10000
-            if "[" in site:
-                open_bracket = site.index("[")
-                close_bracket = site.index("]")
-                binding = site[open_bracket+1:close_bracket]
-            else:
-                binding = None
-            if "{" in site:
-                open_curl = site.index("{")
-                close_curl = site.index("}")
-                state = site[open_curl+1:close_curl]
-            else:
-                state = None
-            if open_bracket < 10000 or open_curl < 10000:
-                name_end = min([open_bracket, open_curl])
-                site_name = site[:name_end]
-            else:
-                site_name = site
+    for agent_match in _AGENT_RE.finditer(rule_str):
+        agent_name = agent_match.group("name")
+        for site in agent_match.group("sites").split():
+            site_match = _SITE_RE.match(site)
+            site_name = site_match.group("name")
+            binding = site_match.group("binding")
+            if binding == None:
+                binding = site_match.group("binding2")
+            state = site_match.group("state")
             if binding != None:
                 species = {"agent": agent_name, "site": site_name,
                            "binding": binding, "state": None}
@@ -10208,40 +10447,37 @@ def type_bonds(req_species, res_species):
     """ Change link numbers to semi-link with type. """
 
     bond_numbers = get_bond_numbers(req_species, res_species)
-    list_index = 0
-    for species_list in [req_species, res_species]:
-        new_species = []
-        for species in species_list:
-            if species["binding"] != None:
-                number = species["binding"]
-                if number != "." and number != "_":
-                    current_site = "{}.{}".format(species["site"],
-                                                  species["agent"])
-                    new_bond = bond_numbers[number][current_site]
-                    period = new_bond.index(".")
-                    bnd_agent = new_bond[period+1:]
-                    bnd_site = new_bond[:period]
-                else:
-                    bnd_agent = number
-                    bnd_site = number
-            else:
-                bnd_agent = None
-                bnd_site = None
-            new_sp = {"agent": species["agent"],
-                      "site": species["site"],
-                      "bound_agent": bnd_agent,
-                      "bound_site": bnd_site,
-                      "state": species["state"]}
-            new_species.append(new_sp)
-        if list_index == 0:
-            new_req = new_species
-            list_index += 1
-        else:
-            new_res = new_species
+    new_req = retype_species(req_species, bond_numbers)
+    new_res = retype_species(res_species, bond_numbers)
 
     return new_req, new_res
 
 
+def retype_species(species_list, bond_numbers):
+    """ Build typed copies of the species from a list for type_bonds. """
+
+    new_species = []
+    for species in species_list:
+        number = species["binding"]
+        if number == None:
+            bnd_agent = None
+            bnd_site = None
+        elif number == "." or number == "_":
+            bnd_agent = number
+            bnd_site = number
+        else:
+            current_site = "{}.{}".format(species["site"], species["agent"])
+            new_bond = bond_numbers[number][current_site]
+            bnd_site, _, bnd_agent = new_bond.partition(".")
+        new_species.append({"agent": species["agent"],
+                            "site": species["site"],
+                            "bound_agent": bnd_agent,
+                            "bound_site": bnd_site,
+                            "state": species["state"]})
+
+    return new_species
+
+
 def get_bond_numbers(req_species, res_species):
     """ Find which agent binds to which agent. """
 
@@ -10325,10 +10561,12 @@ def speciespathway(eoi, kappamodel, causalgraph=None, edgelabels=False,
             found_as_source = False
             found_as_target = False
             for link in new_links:
-                if link.source == rule_res:
+                if link.source is rule_res:
                     found_as_source = True
-                if link.target == rule_res:
+                if link.target is rule_res:
                     found_as_target = True
+                if found_as_source == True and found_as_target == True:
+                    break
             if rule_res.intro == True and found_as_source == True:
                 include_node = True
             elif rule_res.label == eoi and found_as_target == True:
@@ -10341,9 +10579,10 @@ def speciespathway(eoi, kappamodel, causalgraph=None, edgelabels=False,
                 species_pathway.nodes.append(rule_res)
                 if "{" in rule_res.label or rule_node.intro == True:
                     mod_sites.append(rule_res)
+    node_set = set(species_pathway.nodes)
     for link in new_links:
-        if link.source in species_pathway.nodes:
-            if link.target in species_pathway.nodes:
+        if link.source in node_set:
+            if link.target in node_set:
                 species_pathway.edges.append(link)
     print(">>>>", mod_sites)
     rebranch(species_pathway, mod_sites)
@@ -10431,61 +10670,77 @@ def get_rules(eoi, kappamodel, graph):
 def read_kappa_file(kappamodel):
     """ Build a dictionary of the rules from the original kappa model. """
 
-    kappa_file = open(kappamodel, "r").readlines()
     kappa = {}
     kappa["agents"] = {}
     kappa["inits"] = {}
     kappa["rules"] = {}
-    for line in kappa_file:
-        if line[:7] == "%agent:":
-            agent_def = line[7:-1].strip()
-            par = agent_def.index("(")
-            agent_type = agent_def[:par]
-            kappa["agents"][agent_type] = agent_def
-        if line[:6] == "%init:":
-            amount = line[6:-1].strip()
-            space = amount.index(" ")
-            init_def = amount[space:].strip()
-            init_agents = init_def.split(",")
-            agent_type = ""
-            first_agent = True
-            for init_agent in init_agents:
-                if first_agent == False:
-                    agent_type += ", "
-                else:
-                    first_agent = False
-                agent_str = init_agent.strip()
-                par = agent_str.index("(")
-                agent_type += init_def[:par]
-            kappa["inits"][agent_type] = init_def
-        if line[0] == "'":
-            quote = line.rfind("'")
-            rule_name = line[1:quote]
-            a = line.index("@")
-            rule = line[quote+1:a].strip()
-            kappa["rules"][rule_name] = rule
+    declaration_readers = {"%agent": read_agent_declaration,
+                           "%init": read_init_declaration}
+    with open(kappamodel, "r") as kappa_file:
+        for line in kappa_file:
+            if line.startswith("%"):
+                keyword, _, declaration = line.partition(":")
+                if keyword in declaration_readers:
+                    declaration_readers[keyword](declaration.strip(), kappa)
+            elif line.startswith("'"):
+                read_rule_declaration(line, kappa)
 
     return kappa
 
 
+def read_agent_declaration(agent_def, kappa):
+    """ Add the definition from an %agent: line to the kappa dictionary. """
+
+    agent_type, _, _ = agent_def.partition("(")
+    kappa["agents"][agent_type] = agent_def
+
+
+def read_init_declaration(amount, kappa):
+    """ Add the mixture from an %init: line to the kappa dictionary. """
+
+    _, _, init_def = amount.partition(" ")
+    init_def = init_def.strip()
+    init_agents = init_def.split(",")
+    agent_type = ""
+    first_agent = True
+    for init_agent in init_agents:
+        if first_agent == False:
+            agent_type += ", "
+        else:
+            first_agent = False
+        agent_str = init_agent.strip()
+        par = agent_str.index("(")
+        agent_type += init_def[:par]
+    kappa["inits"][agent_type] = init_def
+
+
+def read_rule_declaration(line, kappa):
+    """ Add the rule from a line of the kappa model to the kappa dictionary. """
+
+    rule_def, _, _ = line.partition("@")
+    quote = rule_def.rfind("'")
+    rule_name = rule_def[1:quote]
+    rule = rule_def[quote+1:].strip()
+    kappa["rules"][rule_name] = rule
+
+
 def read_eoi(eoi, kappamodel):
     """ Read EOI from the kappa file with added event of interest. """
 
     period = kappamodel.rfind(".")
     prefix = kappamodel[:period]
     kappa_path = "{}/{}-eoi.ka".format(eoi, prefix)
-    kappa_file = open(kappa_path, "r").readlines()
     eoi_dict = {}
-    for line in kappa_file:
-        if line[:5] == "%obs:":
-            open_quote = line.index("'")
-            close_quote = line.rfind("'")
-            obs = line[open_quote+1:close_quote]
-            if obs == eoi:
-                obs_def = line[close_quote+1:-1].strip()
-                if "|" in obs_def:
-                    obs_def = obs_def[1:-1]
-                eoi_dict[obs] = obs_def
+    with open(kappa_path, "r") as kappa_file:
+        for line in kappa_file:
+            if line.startswith("%obs:"):
+                _, _, obs_str = line.partition("'")
+                obs, _, obs_def = obs_str.rpartition("'")
+                if obs == eoi:
+                    obs_def = obs_def.strip()
+                    if "|" in obs_def:
+                        obs_def = obs_def[1:-1]
+                    eoi_dict[obs] = obs_def
 
     return eoi_dict
 
@@ -10499,67 +10754,45 @@ def build_creation_rules(kappa_dict):
     creations = {}
     for intro in kappa_dict["inits"].keys():
         init = kappa_dict["inits"][intro]
-        init_agents = init.split(",")
-        intro_rule = ""
-        first_agent = True
-        for init_agent_tmp in init_agents:
-            init_agent = init_agent_tmp.strip()
-            if first_agent == False:
-                intro_rule += ", "
-            else:
-                first_agent = False
-            init_dict = build_site_dict(init_agent)
+        agent_strs = []
+        for agent_match in _AGENT_RE.finditer(init):
+            init_dict = build_site_dict(agent_match.group(0))
             agent_name = init_dict["name"]
             def_agent = kappa_dict["agents"][agent_name]
             def_dict = build_site_dict(def_agent)
-            intro_rule += "{}(".format(agent_name)
             init_names = init_dict.keys()
             default_bind = "."
-            first_site = True
+            site_strs = []
             for init_name in init_names:
                 if init_name != "name":
-                    if first_site == False:
-                        intro_rule += " "
-                    else:
-                       first_site = False
-                    intro_rule += "{}".format(init_name)
                     init_site = init_dict[init_name]
                     def_site = def_dict[init_name]
                     init_bind = init_site["binding"]
                     init_state = init_site["state"]
                     if def_site["state"] == None:
                         if init_bind == None:
-                            intro_rule += "[.]"
+                            site_strs.append("{}[.]".format(init_name))
                         else:
-                            intro_rule += "[{}]".format(init_bind)
-                    elif def_site["state"] != None:
-                        comma = def_site["state"].index(",")
-                        default_state = def_site["state"][:comma]
-                        if init_bind == None and init_state == None:
-                            intro_rule += "[{}]{{{}}}".format(default_bind,
-                                                              default_state)
-                        elif init_bind != None and init_state == None:
-                            intro_rule += "[{}]{{{}}}".format(init_bind,
-                                                              default_state)
-                        elif init_bind == None and init_state != None:
-                            intro_rule += "[{}]{{{}}}".format(default_bind,
-                                                              init_state)
-                        elif init_bind != None and init_state != None:
-                            intro_rule += "[{}]{{{}}}".format(init_bind,
-                                                              init_state)
+                            site_strs.append("{}[{}]".format(init_name,
+                                                             init_bind))
+                    else:
+                        if init_bind == None:
+                            init_bind = default_bind
+                        if init_state == None:
+                            init_state = def_site["state"].split(",")[0]
+                        site_strs.append("{}[{}]{{{}}}".format(init_name,
+                                                               init_bind,
+                                                               init_state))
             for def_name in def_dict.keys():
                 if def_name not in init_names:
-                    if first_site == False:
-                        intro_rule += " "
-                    else:
-                       first_site = False
                     def_site = def_dict[def_name]
-                    intro_rule += "{}[{}]".format(def_name, default_bind)
+                    site_str = "{}[{}]".format(def_name, default_bind)
                     if def_site["state"] != None:
-                        comma = def_site["state"].index(",")
-                        default_state = def_site["state"][:comma]
-                        intro_rule += "{{{}}}".format(default_state)
-            intro_rule += ")"
+                        default_state = def_site["state"].split(",")[0]
+                        site_str += "{{{}}}".format(default_state)
+                    site_strs.append(site_str)
+            agent_strs.append("{}({})".format(agent_name, " ".join(site_strs)))
+        intro_rule = ", ".join(agent_strs)
         intro_label = "Intro {}" .format(intro)
         creations[intro_label] = intro_rule
 
@@ -10572,30 +10805,17 @@ def build_site_dict(agent_str):
     """
 
     site_dict = {}
-    par = agent_str.index("(")
-    site_dict["name"] = agent_str[:par]
-    site_list = agent_str[par+1:-1].split()
+    agent_name, _, sites_str = agent_str.partition("(")
+    site_dict["name"] = agent_name
+    site_list = sites_str[:-1].split()
     for site in site_list:
-        open_bracket = 10000
-        open_curl = 10000
-        if "[" in site:
-            open_bracket = site.index("[")
-            close_bracket = site.index("]")
-            binding = site[open_bracket+1:close_bracket]
-        else:
-            binding = None
-        if "{" in site:
-            open_curl = site.index("{")
-            close_curl = site.index("}")
-            state = site[open_curl+1:close_curl]
-        else:
-            state = None
-        if open_bracket < 10000 or open_curl < 10000:
-            name_end = min([open_bracket, open_curl])
-            site_name = site[:name_end]
-        else:
-            site_name = site
-        site_dict[site_name] = {"binding": binding, "state": state}
+        site_match = _SITE_RE.match(site)
+        binding = site_match.group("binding")
+        if binding == None:
+            binding = site_match.group("binding2")
+        state = site_match.group("state")
+        site_dict[site_match.group("name")] = {"binding": binding,
+                                               "state": state}
 
     return site_dict
 
@@ -10648,28 +10868,26 @@ def build_site_str(site_dict):
 #    return mod_nodes
 
 
-def arrow_relationships(eoi, graph):
+def arrow_relationships(eoi, graph, verbose=False):
     """
     Add required site nodes and resulting site nodes to each modification node.
+    Print the sites found for each node if verbose is True.
     """
 
     node_index = 1
     for node in graph.nodes:
         req_sites, res_sites = individual_sites(node.rule)
-        bond_numbers = get_bond_numbers(req_sites, res_sites)
-        req_list = relative_bonds(req_sites, bond_numbers)
-        res_list = relative_bonds(res_sites, bond_numbers)
-        req = []
-        for site in req_list:
-            node_id = "site{}".format(node_index)
-            req.append(CausalNode(node_id, site, rank=node.rank,
-                                  intro=node.intro))
-            node_index += 1
-        res = []
-        for site in res_list:
-            node_id = "site{}".format(node_index)
-            res.append(CausalNode(node_id, site, rank=node.rank))
-            node_index += 1
+        bond_numbers = site_bond_numbers(req_sites, res_sites)
+        req_list = type_bonds2(req_sites, bond_numbers)
+        res_list = type_bonds2(res_sites, bond_numbers)
+        req = [CausalNode("site{}".format(node_index+i), site,
+                          rank=node.rank, intro=node.intro)
+               for i, site in enumerate(req_list)]
+        node_index += len(req_list)
+        res = [CausalNode("site{}".format(node_index+i), site,
+                          rank=node.rank)
+               for i, site in enumerate(res_list)]
+        node_index += len(res_list)
         if node.intro == True:
             node.res = req
             node.req = []
@@ -10680,72 +10898,62 @@ def arrow_relationships(eoi, graph):
             for req_node in node.req:
                 if "[" in req_node.label:
                     node.res.append(req_node)
-        print(node.label,"|", node.rule)
-        print(node.req)
-        print(node.res)
-        print("----")
+        if verbose == True:
+            print(node.label,"|", node.rule)
+            print(node.req)
+            print(node.res)
+            print("----")
 
 
 def individual_sites(rule):
     """
-    Return lists of individual required and resulting sites (species) from a kappa rule.
+    Return lists of individual required and resulting sites from a kappa rule.
+    Each site is given as a tuple (agent, site, kind, value) where kind is
+    either "bind" or "state".
     """
 
     req_sites = []
     res_sites = []
-    agents_list = rule.split(",")
-    for agent_tmp in agents_list:
-        agent = agent_tmp.strip()
-        site_dict = build_site_dict(agent)
-        for site_key in site_dict.keys():
-            site = site_dict[site_key]
-            if site_key != "name":
-                if site["binding"] != None:
-                    if "/" in site["binding"]:
-                        slash = site["binding"].index("/")
-                        preslash = site["binding"][:slash]
-                        #indiv_site = {"name": site_dict["name"],
-                        #              site_key: {"binding": preslash}}
-                        site_str = "{}({}".format(site_dict["name"], site_key)
-                        site_str += "[{}])".format(preslash)
-                        req_sites.append(site_str)
-                        postslash = site["binding"][slash+1:]
-                        #indiv_site = {"name": site_dict["name"],
-                        #              site_key: {"binding": postslash}}
-                        site_str = "{}({}".format(site_dict["name"], site_key)
-                        site_str += "[{}])".format(postslash)
-                        res_sites.append(site_str)
-                    else:
-                        #indiv_site = {"name": site_dict["name"],
-                        #              site_key: {"binding": site["binding"]}}
-                        site_str = "{}({}".format(site_dict["name"], site_key)
-                        site_str += "[{}])".format(site["binding"])
-                        req_sites.append(site_str)
-                if site["state"] != None:
-                    if "/" in site["state"]:
-                        slash = site["state"].index("/")
-                        preslash = site["state"][:slash]
-                        #indiv_site = {"name": site_dict["name"],
-                        #              site_key: {"state": preslash}}
-                        site_str = "{}({}".format(site_dict["name"], site_key)
-                        site_str += "{{{}}})".format(preslash)
-                        req_sites.append(site_str)
-                        postslash = site["state"][slash+1:]
-                        #indiv_site = {"name": site_dict["name"],
-                        #              site_key: {"state": postslash}}
-                        site_str = "{}({}".format(site_dict["name"], site_key)
-                        site_str += "{{{}}})".format(postslash)
-                        res_sites.append(site_str)
-                    else:
-                        #indiv_site = {"name": site_dict["name"],
-                        #              site_key: {"state": site["state"]}}
-                        site_str = "{}({}".format(site_dict["name"], site_key)
-                        site_str += "{{{}}})".format(site["state"])
-                        req_sites.append(site_str)
+    for agent_match in _AGENT_RE.finditer(rule):
+        agent_name = agent_match.group("name")
+        for site in agent_match.group("sites").split():
+            site_match = _SITE_RE.match(site)
+            site_name = site_match.group("name")
+            binding = site_match.group("binding")
+            if binding == None:
+                binding = site_match.group("binding2")
+            state = site_match.group("state")
+            for kind, value in [("bind", binding), ("state", state)]:
+                if value == None:
+                    continue
+                before, slash, after = value.partition("/")
+                req_sites.append((agent_name, site_name, kind, before))
+                if slash:
+                    res_sites.append((agent_name, site_name, kind, after))
 
     return req_sites, res_sites
 
 
+def site_bond_numbers(req_sites, res_sites):
+    """
+    Find which agent binds to which agent from the site tuples returned by
+    individual_sites.
+    """
+
+    bond_numbers_tmp = {}
+    for site_list in [req_sites, res_sites]:
+        for agent, site, kind, number in site_list:
+            if kind == "bind" and number != "." and number != "_":
+                bond_type = "{}.{}".format(site, agent)
+                bond_numbers_tmp.setdefault(number, []).append(bond_type)
+    bond_numbers = {}
+    for number, partners in bond_numbers_tmp.items():
+        bond_numbers[number] = {partners[0]: partners[1],
+                                partners[1]: partners[0]}
+
+    return bond_numbers
+
+
 #def get_bond_numbers(req_sites, res_sites):
 #    """ Find which agent binds to which agent. """
 #
@@ -10773,27 +10981,22 @@ def individual_sites(rule):
 
 
 def type_bonds2(sites, bond_numbers):
-    """ Change link numbers to semi-link with type and remove duplicates. """
+    """
+    Write site tuples as kappa strings, changing link numbers to semi-link
+    with type, and remove duplicates.
+    """
 
     new_sites = []
-    for site in sites:
-        if "[" in site:
-            bracket = site.index("[")
-            number = site[bracket+1:-2]
-            if number != "." and number != "_":
-                par = site.index("(")
-                ag = site[:par]
-                s = site[par+1:bracket]
-                current_site = "{}.{}".format(s, ag)
-                new_site = "{}({}".format(ag, s)
-                new_bond = bond_numbers[number][current_site]
-                new_site += "[{}])".format(new_bond)
-                new_sites.append(new_site)
-            else:
-                new_sites.append(site)
+    for agent, site, kind, value in sites:
+        if kind == "state":
+            new_sites.append("{}({}{{{}}})".format(agent, site, value))
+        elif value == "." or value == "_":
+            new_sites.append("{}({}[{}])".format(agent, site, value))
         else:
-            new_sites.append(site)
-    sites_set = list(set(new_sites))
+            current_site = "{}.{}".format(site, agent)
+            new_bond = bond_numbers[value][current_site]
+            new_sites.append("{}({}[{}])".format(agent, site, new_bond))
+    sites_set = list(dict.fromkeys(new_sites))
     #site_dicts = []
     #for site in sites_set:
     #    site_dict = build_site_dict(site)
@@ -10810,39 +11013,68 @@ def linkresnodes(graph):
     label as any req node from the subsequent rule.
     """
 
+    out_edges = {}
+    for edge in graph.edges:
+        out_edges.setdefault(edge.source, []).append(edge)
+    # Parse the (agent, site) pair of every binding site label only once.
+    site_keys = {}
+    for node in graph.nodes:
+        for site_node in node.req + node.res:
+            label = site_node.label
+            if "[" in label and label not in site_keys:
+                site_keys[label] = site_key(label)
+    # For each target rule, gather the labels of its req nodes and the
+    # (agent, site) pairs of its req nodes with an unspecified binding "[_]",
+    # so that each res node is matched with set lookups.
+    req_keys = {}
     links = []
     for node in graph.nodes:
-        target_rules = []
-        for edge in graph.edges:
-            if edge.source == node:
-                target_rule = edge.target
-                occ = edge.occurrence
-                for node_res in node.res:
-                    link_res_nodes = False
-                    for target_req in target_rule.req:
-                        if "[_]" in target_req.label:
-                            req_par = target_req.label.index("(")
-                            req_bracket = target_req.label.index("[")
-                            req_agent = target_req.label[:req_par]
-                            req_site = target_req.label[req_par+1:req_bracket]
-                            res_par = node_res.label.index("(")
-                            res_bracket = node_res.label.index("[")
-                            res_agent = node_res.label[:res_par]
-                            res_site = node_res.label[res_par+1:res_bracket]
-                            if req_agent == res_agent and req_site == res_site:
-                                link_res_nodes = True
-                                break
-                        elif node_res.label == target_req.label:
-                            link_res_nodes = True
-                            break
-                    if link_res_nodes == True:
-                        for target_res in target_rule.res:
-                            links.append(CausalEdge(node_res, target_res,
-                                                    occurrence=occ))
+        node_res_list = node.res
+        if not node_res_list or node not in out_edges:
+            continue
+        for edge in out_edges[node]:
+            target_rule = edge.target
+            occ = edge.occurrence
+            if target_rule not in req_keys:
+                req_labels = set()
+                req_sites = set()
+                for target_req in target_rule.req:
+                    req_label = target_req.label
+                    if "[_]" in req_label:
+                        # The req label may not be found on graph nodes.
+                        req_site = site_keys.get(req_label)
+                        if req_site == None:
+                            req_site = site_key(req_label)
+                        req_sites.add(req_site)
+                    else:
+                        req_labels.add(req_label)
+                req_keys[target_rule] = (req_labels, req_sites)
+            req_labels, req_sites = req_keys[target_rule]
+            target_res_list = target_rule.res
+            for node_res in node_res_list:
+                res_label = node_res.label
+                link_res_nodes = False
+                if res_label in req_labels:
+                    link_res_nodes = True
+                elif req_sites and site_keys.get(res_label) in req_sites:
+                    link_res_nodes = True
+                if link_res_nodes == True:
+                    for target_res in target_res_list:
+                        links.append(CausalEdge(node_res, target_res,
+                                                occurrence=occ))
 
     return links
 
 
+def site_key(label):
+    """ Return the (agent, site) pair of a binding site label. """
+
+    agent, _, rest = label.partition("(")
+    site, _, _ = rest.partition("[")
+
+    return (agent, site)
+
+
 def oldspeciespathway(eoi, kappamodel, causalgraph=None, edgelabels=False,
                    hideintro=False):
     """
@@ -10866,8 +11098,9 @@ def oldspeciespathway(eoi, kappamodel, causalgraph=None, edgelabels=False,
     added_nodes = []
     for node in added_nodes:
         mod_nodes.append(node)
+    mod_set = set(mod_nodes)
     for node in pathway.nodes:
-        if node in mod_nodes:
+        if node in mod_set:
             node.label = node.species
     rebranch(pathway, mod_nodes)
     merge_same_labels(pathway)
@@ -10895,71 +11128,65 @@ def oldspeciespathway(eoi, kappamodel, causalgraph=None, edgelabels=False,
     
 def get_kappa_rules(kappamodel):
     """ Build a dictionary of the rules from the input kappa model. """
-    
-    kappa_file = open(kappamodel, "r").readlines()
+
+    # The file is parsed again only if it was modified since last call.
+    mtime = os.path.getmtime(kappamodel)
+    kappa_rules = read_kappa_rules(kappamodel, mtime)
+
+    return kappa_rules.copy()
+
+
+@functools.lru_cache(maxsize=1)
+def read_kappa_rules(kappamodel, mtime):
+    """
+    Read the rules of a kappa model for get_kappa_rules. The mtime argument
+    is only used to key the cache on the version of the file.
+    """
+
     kappa_rules = {}
-    for line in kappa_file:
-        if line[0] == "'":
-            quote = line.rfind("'")
-            rule_name = line[1:quote]
-            rule_strt = 0
-            for i in range(quote+1, len(line)):
-                if line[i] != " ":
-                    rule_strt = i
-                    break
-            rule = line[rule_strt:-1]
-            kappa_rules[rule_name] = rule
+    with open(kappamodel, "r") as kappa_file:
+        for line in kappa_file:
+            if line.startswith("'"):
+                quote = line.find("'", 1)
+                rule_name = line[1:quote]
+                rule = line[quote+1:].strip()
+                kappa_rules[rule_name] = rule
 
     return kappa_rules
 
 
+@functools.lru_cache(maxsize=None)
 def parse_rule(rule):
     """
-    Create a dict for given rule.
-    agent_dict = {"type": X ,
-                  "sites": {"site1": {"binding": "1", "state": "p"},
-                            "site2": {"binding": "3", "state": "u"}
-                           }
-                 }
+    Create a tuple of the agents of given rule.
+    agent = (X, (("site1", "1", "p"),
+                 ("site2", "3", "u")))
+    Results are cached by rule string and shared between calls, which is
+    why they are immutable.
     """
 
     parsed_agents = []
     if "@" in rule:
-        a = rule.index("@")
-        rate = rule[a+1:]
-        agents_list = rule[:a-1].split(', ')
+        agents_str, _, rate = rule.partition("@")
+        agents_list = agents_str[:-1].split(', ')
     elif "|" in rule:
         agents_list = rule[1:-1].split(', ')
     else:
         agents_list = rule.split(', ')
     for agent in agents_list:
-        agent_dict = {}
-        parenthesis = agent.index("(")
-        agent_type = agent[:parenthesis]
-        agent_dict["type"] = agent_type
-        sites = agent[parenthesis+1:-1].split()
-        site_dict = {}
+        agent_type, _, sites_str = agent.partition("(")
+        sites = sites_str[:-1].split()
+        site_list = []
         for site in sites:
-            if "[" in site:
-                open_bracket = site.index("[")
-                close_bracket = site.index("]")
-                site_id = site[:open_bracket]
-                binding = site[open_bracket+1:close_bracket]
-            else:
-                binding = None
-            if "{" in site:
-                open_curl = site.index("{")
-                close_curl = site.index("}")
-                if "[" not in site:
-                    site_id = site[:open_curl]
-                state = site[open_curl+1:close_curl]
-            else:
-                state = None
-            site_dict[site_id] = {"binding": binding, "state": state}
-        agent_dict["sites"] = site_dict
-        parsed_agents.append(agent_dict)
+            site_match = _SITE_RE.match(site)
+            binding = site_match.group("binding")
+            if binding == None:
+                binding = site_match.group("binding2")
+            state = site_match.group("state")
+            site_list.append((site_match.group("name"), binding, state))
+        parsed_agents.append((agent_type, tuple(site_list)))
 
-    return parsed_agents
+    return tuple(parsed_agents)
 
 
 #def get_mod_nodes(eoi, graph, kappa_rules):
@@ -11103,13 +11330,13 @@ def add_first_nodes(graph, kappa_rules, mod_nodes):
         modified_agent = modified_agents[i]
         modified_types = []
         for mod_ag in modified_agent:
-            modified_types.append(mod_ag["type"])
+            modified_types.append(mod_ag[0])
         all_agents = seen_agents[i]
         required_agents = []
         for agent in all_agents:
-            if agent["type"] not in modified_types:             
-                if agent["type"] not in required_agents:
-                    required_agents.append(agent["type"])
+            if agent[0] not in modified_types:             
+                if agent[0] not in required_agents:
+                    required_agents.append(agent[0])
         if len(required_agents) == 0:
             new_edge = CausalEdge(modified_node, modified_node,
                                   path_probs[i])
@@ -11137,27 +11364,40 @@ def rebranch(graph, mod_nodes):
     downstream nodes.
     """
 
-    for j in range(len(graph.nodes)-1, -1, -1):
-        node = graph.nodes[j]
-        if node not in mod_nodes:
+    # Index edges by target and by source. Edges are kept in a dict to
+    # preserve their order while allowing removal in constant time.
+    remaining_edges = dict.fromkeys(graph.hyperedges)
+    edges_by_target = {}
+    edges_by_source = {}
+    for edge in graph.hyperedges:
+        edges_by_target.setdefault(edge.target, []).append(edge)
+        edges_by_source.setdefault(edge.source, []).append(edge)
+    mod_set = set(mod_nodes)
+    removed_nodes = set()
+    for node in reversed(graph.nodes):
+        if node not in mod_set:
             up_edges = []
-            for i in range(len(graph.hyperedges)-1, -1, -1):
-                edge = graph.hyperedges[i]
-                if edge.target == node:
+            for edge in reversed(edges_by_target.pop(node, [])):
+                if edge in remaining_edges:
                     up_edges.append(edge)
-                    del(graph.hyperedges[i])
+                    del(remaining_edges[edge])
             down_edges = []
-            for i in range(len(graph.hyperedges)-1, -1, -1):
-                edge = graph.hyperedges[i]
-                if edge.source == node:
+            for edge in reversed(edges_by_source.pop(node, [])):
+                if edge in remaining_edges:
                     down_edges.append(edge)
-                    del(graph.hyperedges[i])
-            for up_edge in up_edges:
-                for down_edge in down_edges:
-                    new_edge = CausalEdge(up_edge.source, down_edge.target,
-                                          up_edge.prob)
-                    graph.hyperedges.append(new_edge)
-            del(graph.nodes[j])
+                    del(remaining_edges[edge])
+            new_edges = [CausalEdge(up_edge.source, down_edge.target,
+                                    up_edge.prob)
+                         for up_edge in up_edges for down_edge in down_edges]
+            for new_edge in new_edges:
+                remaining_edges[new_edge] = None
+                edges_by_target.setdefault(new_edge.target,
+                                           []).append(new_edge)
+                edges_by_source.setdefault(new_edge.source,
+                                           []).append(new_edge)
+            removed_nodes.add(node)
+    graph.hyperedges = list(remaining_edges)
+    graph.nodes = [node for node in graph.nodes if node not in removed_nodes]
     #graph.update()
 
 # """"""""""" End of Species Pathway Conversion Section """""""""""""""""""""""
@@ -11193,15 +11433,32 @@ def drawpngs(eoi, graphvizpath):
 
     dot_files = get_dot_files(eoi)
     print("Drawing {} graphs.".format(len(dot_files)))
+    # Each graph is drawn by its own dot process, run them in parallel.
+    workers = os.cpu_count()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    futures = []
     for dot_file in dot_files:
         period = dot_file.rfind(".")
         file_path = "{}/{}".format(eoi, dot_file[:period])
-        try:
-            subprocess.run(("/usr/bin/dot", "-Tpng",
-                            "{}.dot".format(file_path),
-                            "-o", "{}.png".format(file_path)))
-        except KeyboardInterrupt:
-            exit(0)
+        futures.append(executor.submit(draw_png, file_path, graphvizpath))
+    try:
+        for future in futures:
+            future.result()
+    except KeyboardInterrupt:
+        executor.shutdown(wait=False, cancel_futures=True)
+        exit(1)
+    executor.shutdown()
+
+
+def draw_png(file_path, graphvizpath):
+    """
+    Draw the png of a single dot file, file_path has no extension and
+    graphvizpath is the path to the dot program.
+    """
+
+    subprocess.run(("{}".format(graphvizpath), "-Tpng",
+                    "{}.dot".format(file_path),
+                    "-o", "{}.png".format(file_path)))
 
 
 def togglelabels():
@@ -11226,35 +11483,30 @@ def toggle_edge_labels(dir_path, dot_file):
     """ Add or remove edge labels in dot file. """
 
     input_path = "{}/{}".format(dir_path, dot_file)
-    input_file = open(input_path, "r").readlines()
-    new_file = ""
-    for line in input_file:
-        if "->" in line and "penwidth" in line:
-            if "label" not in line: # Add labels.
-                ppos = line.index("prob=")
-                bracket = line.index("]")
-                prob = line[ppos+7:bracket]
-                comma = line.rfind(",")
-                new_line = line[:comma+2]
-                new_line += 'label="  {}", '.format(prob)
-                new_line += line[ppos:]
-                new_file += new_line
-            else: # Remove labels.
-                labelpos = line.index("label=")
-                comma = line.rfind(",")
-                new_line = line[:labelpos] + line[comma+1:]
-                new_file += new_line
-        else:
-            new_file += line
+    with open(input_path, "r") as input_file:
+        content = input_file.read()
+    new_file = _EDGE_LINE_RE.sub(toggle_edge_label, content)
+    overwrite_file(input_path, [new_file])
+
+
+def toggle_edge_label(match):
+    """ Add or remove the label of a single dot edge line. """
+
+    line = match.group(0)
+    if "label" not in line: # Add labels.
+        ppos = line.index("prob=")
+        bracket = line.index("]")
+        prob = line[ppos+7:bracket]
+        comma = line.rfind(",")
+        new_line = line[:comma+2]
+        new_line += 'label="  {}", '.format(prob)
+        new_line += line[ppos:]
+    else: # Remove labels.
+        labelpos = line.index("label=")
+        comma = line.rfind(",")
+        new_line = line[:labelpos] + line[comma+1:]
 
-    period = dot_file.rfind(".")
-    prefix = dot_file[:period]
-    save_path = "{}/{}-save.dot".format(dir_path, prefix)
-    shutil.copyfile(input_path, save_path)
-    os.remove(input_path)
-    output_file = open(input_path, "w")
-    output_file.write(new_file)
-    os.remove(save_path)
+    return new_line
 
 
 def toggleintros():
@@ -11281,41 +11533,53 @@ def toggle_intro_nodes(dir_path, dot_file):
     """ Show or hide intro nodes in dot file. """
 
     input_path = "{}/{}".format(dir_path, dot_file)
-    input_file = open(input_path, "r").readlines()
-    new_file = ""
-    node_ids = []
+    with open(input_path, "r") as input_file:
+        overwrite_file(input_path, toggle_intro_lines(input_file))
+
+
+def toggle_intro_lines(input_lines):
+    """
+    Yield the lines of a dot file with intro nodes, their edges and rank 0
+    shown or hidden.
+    """
+
+    node_ids = set()
     rank0 = False
-    for line in input_file:
+    for line in input_lines:
         if "intro=True" in line:
-            new_file += toggle_comment(line)
+            yield toggle_comment(line)
             tokens = line.split()
-            node_ids.append(tokens[0].strip("/"))
+            node_ids.add(tokens[0].strip("/"))
         elif 'rank = same ; "0"' in line:
-            new_file += toggle_comment(line)
+            yield toggle_comment(line)
             rank0 = True
         elif rank0 == True and line[-2] == "}":
-            new_file += toggle_comment(line)
+            yield toggle_comment(line)
             rank0 = False
         elif '"0" -> "1" [style="invis"]' in line:
-            new_file += toggle_comment(line)
+            yield toggle_comment(line)
         elif "->" in line:
             tokens = line.split()
             source = tokens[0].strip("/")
             target = tokens[2]
             if source in node_ids or target in node_ids:
-                new_file += toggle_comment(line)
+                yield toggle_comment(line)
             else:
-                new_file += line
+                yield line
         else:
-            new_file += line
-    period = dot_file.rfind(".")
-    prefix = dot_file[:period]
-    save_path = "{}/{}-save.dot".format(dir_path, prefix)
-    shutil.copyfile(input_path, save_path)
-    os.remove(input_path)
-    output_file = open(input_path, "w")
-    output_file.write(new_file)
-    os.remove(save_path)
+            yield line
+
+
+def overwrite_file(file_path, chunks):
+    """
+    Replace the content of a file with the given strings by writing them to
+    a temporary file next to it and renaming it over the original.
+    """
+
+    temp_path = "{}.tmp".format(file_path)
+    with open(temp_path, "w") as output_file:
+        output_file.writelines(chunks)
+    os.replace(temp_path, file_path)
 
 
 def toggle_comment(line):
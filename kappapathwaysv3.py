@@ -6,6 +6,8 @@ Obtain the pathway to a given event of interest from a Kappa simulation.
 """
 
 import os
+import re
+import sys
 import shutil
 import subprocess
 import warnings
@@ -14,20 +16,37 @@ import math
 import statistics
 import random
 import copy
+import collections
 import textwrap
 import time
 
 
+# Graph attributes read from dot file lines, e.g. 'maxrank="5"'.
+_DOT_ATTRIBUTE_RE = re.compile(r"precedenceonly=|meshedgraph=|nodestype=|"
+                               r"showintro=|eoi=|Occurrence|maxrank=|"
+                               r"rank = same")
+
+
 class EventNode(object):
     """
     An event node to use in causal graphs. It represents a specific event in
     causal cores and an event type (a rule) in pathways.
     """
 
+    __slots__ = ("nodeid", "label", "rank", "uses", "usage", "occurrence",
+                 "rel_occ", "intro", "first", "highlighted", "pos",
+                 # Set outside of __init__ by mapping and species functions.
+                 "corerank", "rule", "req", "res", "req_species",
+                 "res_species", "full_req", "species", "species_nodes")
+    kind = "event"
+
     def __init__(self, nodeid, label, rank=None, uses=1, usage=1.0,
                  occurrence=1, rel_occ=1.0, intro=False, first=False,
-                 highlighted=False, pos=None, eventid=None):
-        """ Initialize class EventNode. """
+                 highlighted=False, pos=None, eventid=None, checktypes=True):
+        """
+        Initialize class EventNode. Use checktypes=False only when the
+        arguments are known to have proper types.
+        """
 
         self.nodeid = nodeid
         self.label = label
@@ -40,7 +59,8 @@ class EventNode(object):
         self.first = first
         self.highlighted = highlighted
         self.pos = pos
-        self.check_types()
+        if checktypes == True:
+            self.check_types()
 
 
     def check_types(self):
@@ -79,12 +99,20 @@ class CausalEdge(object):
     can be precedence (default), causal or conflict.
     """
 
+    __slots__ = ("source", "target", "uses", "usage", "occurrence", "rel_occ",
+                 "weight", "relationtype", "color", "underlying", "reverse",
+                 "labelcarrier", "indicator", "meshid", "pos", "labelpos",
+                 "overridewidth", "overridelabel")
+
     def __init__(self, source, target, uses=1, usage=1.0, occurrence=1,
                  rel_occ=1.0, relationtype="precedence", color="black",
                  underlying=False, reverse=False, labelcarrier=True,
                  indicator=False, meshid=None, pos=None, labelpos=None,
-                 overridewidth=None, overridelabel=None):
-        """ Initialize class CausalEdge. """
+                 overridewidth=None, overridelabel=None, checktypes=True):
+        """
+        Initialize class CausalEdge. Use checktypes=False only when the
+        arguments are known to have proper types.
+        """
 
         self.source = source
         self.target = target
@@ -104,7 +132,8 @@ class CausalEdge(object):
         self.labelpos = labelpos
         self.overridewidth = overridewidth
         self.overridelabel = overridelabel
-        self.check_types()
+        if checktypes == True:
+            self.check_types()
 
 
     def check_types(self):
@@ -146,10 +175,19 @@ class MidNode(object):
     (white by default).
     """
 
+    __slots__ = ("nodeid", "label", "rank", "midtype", "ghost", "logic",
+                 "fillcolor", "bordercolor", "pos", "overridewidth",
+                 # Set outside of __init__ by set_core_colors.
+                 "corerank")
+    kind = "mid"
+
     def __init__(self, nodeid, rank=None, midtype="enabling", ghost=False,
                  logic="and", fillcolor="black", bordercolor="black",
-                 pos=None, overridewidth=None):
-        """ Initialize class MidNode. """
+                 pos=None, overridewidth=None, checktypes=True):
+        """
+        Initialize class MidNode. Use checktypes=False only when the
+        arguments are known to have proper types.
+        """
 
         self.nodeid = nodeid
         self.label = ""
@@ -163,7 +201,8 @@ class MidNode(object):
         self.overridewidth = overridewidth
         if self.midtype == "involvement":
             self.fillcolor = "white"
-        self.check_types()
+        if checktypes == True:
+            self.check_types()
 
 
     def check_types(self):
@@ -194,6 +233,8 @@ class MidEdge(CausalEdge):
     be either an EventNode or a MidNode.
     """
 
+    __slots__ = ()
+
     def check_types(self):
         """ Check that MidEdge attributes have proper types. """
 
@@ -213,6 +254,11 @@ class Mesh(object):
     A mesh is made of a group of edges glued together by intermediary nodes.
     """
 
+    __slots__ = ("uses", "usage", "occurrence", "rel_occ", "weight",
+                 "underlying", "color", "meshid", "midnodes", "midedges",
+                 # Set outside of __init__ by mapping functions.
+                 "rank", "count", "totcount", "corerank", "skip", "outgoing")
+
     def __init__(self, uses=1, usage=1.0, occurrence=1, rel_occ=1.0,
                  underlying=False, color="black", meshid=None):
         """ Initialize class Mesh. """
@@ -234,41 +280,53 @@ class Mesh(object):
         Return de sources and target nodes that are events from mesh object.
         """
 
-        sources = []
-        targets = []
+        # Dicts keep the first appearance order while removing duplicates.
+        sources = {}
+        targets = {}
         for midedge in self.midedges:
-            if isinstance(midedge.source, EventNode):
-                if midedge.source not in sources:
-                    sources.append(midedge.source)
-            if isinstance(midedge.target, EventNode):
-                if midedge.target not in targets:
-                    targets.append(midedge.target)
+            if midedge.source.kind == "event":
+                sources[midedge.source] = None
+            if midedge.target.kind == "event":
+                targets[midedge.target] = None
 
-        return sources, targets
+        return list(sources), list(targets)
+
+
+    def index_midedges(self):
+        """
+        Return two dicts giving the midedges of the mesh that start from
+        and that end at each node, in the order of self.midedges.
+        """
+
+        by_source = {}
+        by_target = {}
+        for midedge in self.midedges:
+            by_source.setdefault(midedge.source, []).append(midedge)
+            by_target.setdefault(midedge.target, []).append(midedge)
+
+        return by_source, by_target
 
 
     def extend_midnodes(self):
         """ Get event nodes connected to each midnode. """
 
+        by_source, by_target = self.index_midedges()
         neighbors = []
         for midnode in self.midnodes:
             event_srcs = []
             event_trgs = []
-            for midedge in self.midedges:
-                if midedge.target == midnode:
-                    if isinstance(midedge.source, EventNode):
-                        event_srcs.append(midedge.source)
-                    elif isinstance(midedge.source, MidNode):
-                        for midedge2 in self.midedges:
-                            if midedge2.target == midedge.source:
-                                event_srcs.append(midedge2.source)
-                if midedge.source == midnode:
-                    if isinstance(midedge.target, EventNode):
-                        event_trgs.append(midedge.target)
-                    elif isinstance(midedge.target, MidNode):
-                        for midedge2 in self.midedges:
-                            if midedge2.source == midedge.target:
-                                event_trgs.append(midedge2.target)
+            for midedge in by_target.get(midnode, []):
+                if midedge.source.kind == "event":
+                    event_srcs.append(midedge.source)
+                elif midedge.source.kind == "mid":
+                    for midedge2 in by_target.get(midedge.source, []):
+                        event_srcs.append(midedge2.source)
+            for midedge in by_source.get(midnode, []):
+                if midedge.target.kind == "event":
+                    event_trgs.append(midedge.target)
+                elif midedge.target.kind == "mid":
+                    for midedge2 in by_source.get(midedge.target, []):
+                        event_trgs.append(midedge2.target)
             neighbors.append({"srcs": event_srcs, "trgs": event_trgs})
 
         return neighbors
@@ -282,33 +340,32 @@ class Mesh(object):
         from an enabling to an event node).
         """
 
+        by_source, by_target = self.index_midedges()
         neighbors = []
         for midedge in self.midedges:
             # Filter edges.
             src_is_inv = False
-            if isinstance(midedge.source, MidNode):
+            if midedge.source.kind == "mid":
                 if midedge.source.midtype == "involvement":
                     src_is_inv = True
             trg_is_ena = False
-            if isinstance(midedge.target, MidNode):
+            if midedge.target.kind == "mid":
                 if midedge.target.midtype == "enabling":
                     trg_is_ena = True
             # Get the neighbors of filtered edges.
             if src_is_inv == True or trg_is_ena == True:
                 event_srcs = []
                 event_trgs = []
-                if isinstance(midedge.source, EventNode):
+                if midedge.source.kind == "event":
                     event_srcs.append(midedge.source)
-                elif isinstance(midedge.source, MidNode):
-                    for midedge2 in self.midedges:
-                        if midedge2.target == midedge.source:
-                            event_srcs.append(midedge2.source)
-                if isinstance(midedge.target, EventNode):
+                elif midedge.source.kind == "mid":
+                    for midedge2 in by_target.get(midedge.source, []):
+                        event_srcs.append(midedge2.source)
+                if midedge.target.kind == "event":
                     event_trgs.append(midedge.target)
-                elif isinstance(midedge.target, MidNode):
-                    for midedge2 in self.midedges:
-                        if midedge2.source == midedge.target:
-                            event_trgs.append(midedge2.target)
+                elif midedge.target.kind == "mid":
+                    for midedge2 in by_source.get(midedge.target, []):
+                        event_trgs.append(midedge2.target)
                 neighbors.append({"reltype": midedge.relationtype,
                                   "srcs": event_srcs, "trgs": event_trgs})
 
@@ -321,20 +378,20 @@ class Mesh(object):
         """
 
         sources = []
-        enablings = []
-        involvements = []
+        enablings = set()
+        involvements = set()
         for midedge in self.midedges:
             if midedge.target == targetnode:
-                if isinstance(midedge.source, EventNode):
+                if midedge.source.kind == "event":
                     sources.append(midedge.source)
-                elif isinstance(midedge.source, MidNode):
-                    enablings.append(midedge.source)
+                elif midedge.source.kind == "mid":
+                    enablings.add(midedge.source)
         for midedge in self.midedges:
             if midedge.target in enablings:
-                if isinstance(midedge.source, EventNode):
+                if midedge.source.kind == "event":
                     sources.append(midedge.source)
-                elif isinstance(midedge.source, MidNode):
-                    involvements.append(midedge.source)
+                elif midedge.source.kind == "mid":
+                    involvements.add(midedge.source)
         for midedge in self.midedges:
             if midedge.target in involvements:
                 sources.append(midedge.source)
@@ -348,20 +405,20 @@ class Mesh(object):
         """
 
         targets = []
-        involvements = []
-        enablings = []
+        involvements = set()
+        enablings = set()
         for midedge in self.midedges:
             if midedge.source == sourcenode:
-                if isinstance(midedge.target, EventNode):
+                if midedge.target.kind == "event":
                     targets.append(midedge.target)
-                elif isinstance(midedge.target, MidNode):
-                    involvements.append(midedge.target)
+                elif midedge.target.kind == "mid":
+                    involvements.add(midedge.target)
         for midedge in self.midedges:
             if midedge.source in involvements:
-                if isinstance(midedge.target, EventNode):
+                if midedge.target.kind == "event":
                     targets.append(midedge.target)
-                elif isinstance(midedge.target, MidNode):
-                    enablings.append(midedge.target)
+                elif midedge.target.kind == "mid":
+                    enablings.add(midedge.target)
         for midedge in self.midedges:
             if midedge.source in enablings:
                 targets.append(midedge.target)
@@ -380,9 +437,9 @@ class Mesh(object):
             for midedge in self.midedges:
                 sources = self.get_sources(midedge.source)
                 targets = self.get_targets(midedge.target)
-                if isinstance(midedge.source, EventNode):
+                if midedge.source.kind == "event":
                     sources.insert(0, midedge.source)
-                if isinstance(midedge.target, EventNode):
+                if midedge.target.kind == "event":
                     targets.insert(0, midedge.target)
                 src_ranks = []
                 trg_ranks = []
@@ -440,13 +497,13 @@ class Mesh(object):
                     break
             if contains_enablings == True:
                 for midedge in self.midedges:
-                    if isinstance(midedge.source, MidNode):
+                    if midedge.source.kind == "mid":
                         if midedge.source.midtype == "enabling":
                             midedge.labelcarrier = True
                             break
             elif contains_enablings == False:
                 for midedge in self.midedges:
-                    if isinstance(midedge.source, MidNode):
+                    if midedge.source.kind == "mid":
                         midedge.labelcarrier = True
                         break
         elif len(self.midedges) == 1:
@@ -454,13 +511,28 @@ class Mesh(object):
 
 
     def __repr__(self):
-        """ Representation of the Mesh object. """
+        """
+        Short representation of the Mesh object. Use describe to list its
+        midnodes and midedges.
+        """
+
+        res = "Mesh  uses: {}".format(self.uses)
+        if self.meshid != None:
+            res += ",  id: {}".format(self.meshid)
+        res += ",  midnodes: {}".format(len(self.midnodes))
+        res += ",  midedges: {}".format(len(self.midedges))
+
+        return res
+
+
+    def describe(self):
+        """ Full description of the Mesh with its midnodes and midedges. """
 
         res = "Mesh"
         if self.uses != None:
-            res += "  uses = {}".format(self.occurrence)
-        if self.prob != None:
-            res += "  usage = {:.3f}".format(self.prob)
+            res += "  uses = {}".format(self.uses)
+        if self.usage != None:
+            res += "  usage = {:.3f}".format(self.usage)
         res += "\n\n"
         res +=  "MidNodes:\n\n"
         for midnode in self.midnodes:
@@ -505,6 +577,9 @@ class CausalGraph(object):
         self.covermidedges = []
         self.covermeshes = []
         self.covermidnodegroups = []
+        # Causal edges indexed by source and target event nodes.
+        self.in_edges = {}
+        self.out_edges = {}
         # Post-computed variables.
         self.occurrence = 1
         self.maxrank = None
@@ -520,41 +595,48 @@ class CausalGraph(object):
 
         rank = None
         self.label_mapping = {}
-        dotfile = open(dotpath, "r").readlines()
+        edge_lines = []
+        dotfile = open(dotpath, "r")
         for line in dotfile:
-            if 'precedenceonly="True"' in line:
-                self.precedenceonly = True
-            if 'precedenceonly="False"' in line:
-                self.precedenceonly = False
-            if 'meshedgraph="True"' in line:
-                self.meshedgraph = True
-            if "nodestype=" in line:
-                type_index = line.index("nodestype")
-                quote = line.rfind('"')
-                self.nodestype = line[type_index+11:quote]
-            if 'showintro="False"' in line:
-                self.showintro = False
-            if "eoi=" in line:
-                eoi_index = line.index("eoi")
-                quote = line.rfind('"')
-                self.eoi = line[eoi_index+5:quote]
-            if "Occurrence" in line:
-                occu = line.index("Occurrence")
-                quote = line[occu:].index('"')+occu
-                occu_str = line[occu+12:quote]
-                if "/" in occu_str:
-                    slash = occu_str.index("/")
-                    occu_str = occu_str[:slash-1]
-                self.occurrence = int(occu_str)
-            if "maxrank=" in line:
-                maxrank_index = line.index("maxrank")
-                quote = line.rfind('"')
-                self.maxrank = int(line[maxrank_index+9:quote])
-            if "rank = same" in line:
-                open_quote = line.index('"')
-                close_quote = line[open_quote+1:].index('"')+open_quote+1
-                medrank = float(line[open_quote+1:close_quote])
-                rank = int(medrank)
+            # Keep edge lines to read them once all nodes are known.
+            if "->" in line and '[style="invis"]' not in line:
+                edge_lines.append(line)
+            # Most lines hold no graph attribute, skip them with a single
+            # scan instead of testing each attribute in turn.
+            if _DOT_ATTRIBUTE_RE.search(line) != None:
+                if 'precedenceonly="True"' in line:
+                    self.precedenceonly = True
+                if 'precedenceonly="False"' in line:
+                    self.precedenceonly = False
+                if 'meshedgraph="True"' in line:
+                    self.meshedgraph = True
+                if "nodestype=" in line:
+                    type_index = line.index("nodestype")
+                    quote = line.rfind('"')
+                    self.nodestype = line[type_index+11:quote]
+                if 'showintro="False"' in line:
+                    self.showintro = False
+                if "eoi=" in line:
+                    eoi_index = line.index("eoi")
+                    quote = line.rfind('"')
+                    self.eoi = line[eoi_index+5:quote]
+                if "Occurrence" in line:
+                    occu = line.index("Occurrence")
+                    quote = line[occu:].index('"')+occu
+                    occu_str = line[occu+12:quote]
+                    if "/" in occu_str:
+                        slash = occu_str.index("/")
+                        occu_str = occu_str[:slash-1]
+                    self.occurrence = int(occu_str)
+                if "maxrank=" in line:
+                    maxrank_index = line.index("maxrank")
+                    quote = line.rfind('"')
+                    self.maxrank = int(line[maxrank_index+9:quote])
+                if "rank = same" in line:
+                    open_quote = line.index('"')
+                    close_quote = line[open_quote+1:].index('"')+open_quote+1
+                    medrank = float(line[open_quote+1:close_quote])
+                    rank = int(medrank)
             if line[0] == "}":
                 rank = None
             # Read nodes.
@@ -572,6 +654,9 @@ class CausalGraph(object):
                         node_id = "node{}".format(ori_id)
                     else:
                         node_id = ori_id
+                    # Interned ids make the id lookups of edges cheaper.
+                    ori_id = sys.intern(ori_id)
+                    node_id = sys.intern(node_id)
                     label_start = read_line.index("label=")+7
                     label_end = read_line[label_start:].index('"')+label_start
                     label_str = read_line[label_start:label_end].strip()
@@ -596,7 +681,8 @@ class CausalGraph(object):
                         bordercolor = get_field(" color=", read_line, "black")
                         new_midnode = MidNode(ori_id, rank, midtype,
                                               ghost=ghost, fillcolor=fillcolor,
-                                              bordercolor=bordercolor)
+                                              bordercolor=bordercolor,
+                                              checktypes=False)
                         if 'cover="True"' not in line:
                             self.midnodes.append(new_midnode)
                         elif 'cover="True"' in line:
@@ -605,108 +691,107 @@ class CausalGraph(object):
                         self.eventnodes.append(EventNode(node_id, label,
                                                          rank,
                                                          intro=is_intro,
-                                                         first=is_first))
+                                                         first=is_first,
+                                                         checktypes=False))
                         self.label_mapping[node_id] = label
+        dotfile.close()
+        # Index nodes by id. When ids are repeated, the last node found in
+        # eventnodes, then midnodes, then covermidnodes is used.
+        nodes_by_id = {}
+        for node in self.eventnodes + self.midnodes + self.covermidnodes:
+            nodes_by_id[node.nodeid] = node
         # Read edges.
         tmp_edges = []
         tmp_midedges = []
         tmp_cedges = []
         tmp_cmidedges = []
-        for line in dotfile:
-            if "->" in line and '[style="invis"]' not in line:
-                if line[0:2] == "//":
-                    read_line = line[2:]
-                    underlying = True
-                else:
-                    read_line = line
-                    underlying = False
-                tokens = read_line.split()
-                source_id = tokens[0]
-                if '"' in source_id:
-                    source_id = source_id[1:-1]
-                if "node" not in source_id and "mid" not in source_id:
-                    source_id = "node{}".format(source_id)
-                target_id = tokens[2]
-                if '"' in target_id:
-                    target_id = target_id[1:-1]
-                if "node" not in target_id and "mid" not in target_id:
-                    target_id = "node{}".format(target_id)
-                source = None
-                target = None
-                for node in self.eventnodes:
-                    if node.nodeid == source_id:
-                        source = node
-                    if node.nodeid == target_id:
-                        target = node
-                for node in self.midnodes:
-                    if node.nodeid == source_id:
-                        source = node
-                    if node.nodeid == target_id:
-                        target = node
-                for node in self.covermidnodes:
-                    if node.nodeid == source_id:
-                        source = node
-                    if node.nodeid == target_id:
-                        target = node
-                meshid = get_field("meshid=", read_line, 1)
-                meshid = int(meshid)
-                uses = get_field("uses=", read_line, 1)
-                uses = int(uses)
-                color = get_field("color=", read_line, "black")
-                if "label=" in line:
-                    labelcarrier = True
-                else:
-                    labelcarrier = False
-                if self.precedenceonly == False:
-                    if self.meshedgraph == False:
-                        if "color=grey" in line:
-                            edgetype = "conflict"
-                        else:
-                            edgetype = "causal"
-                    elif self.meshedgraph == True:
-                        if "style=dotted" in line:
-                            edgetype = "conflict"
-                        else:
-                            edgetype = "causal"
-                else:
-                    edgetype = "precedence"
-                if "rev=True" in line:
-                   rev = True
-                   source_save = source
-                   source = target
-                   target = source_save
-                else:
-                   rev = False
-                source_is_mid = isinstance(source, MidNode)
-                target_is_mid = isinstance(target, MidNode)
-                if source_is_mid or target_is_mid:
-                    new_edge = MidEdge(source, target, uses=uses,
-                                       relationtype=edgetype, reverse=rev,
-                                       meshid=meshid, underlying=underlying,
-                                       color=color, labelcarrier=labelcarrier)
-                    if 'cover="True"' not in line:
-                        tmp_midedges.append(new_edge)
-                    elif 'cover="True"' in line:
-                        tmp_cmidedges.append(new_edge)
-                else:
-                    new_edge = CausalEdge(source, target, uses=uses,
-                                          relationtype=edgetype, meshid=meshid,
-                                          underlying=underlying, color=color)
-                    if 'cover="True"' not in line:
-                        tmp_edges.append(new_edge)
-                    elif 'cover="True"' in line:
-                        tmp_cedges.append(new_edge)
-        for edge in tmp_edges:
-            self.causaledges.insert(0, edge)
-        for midedge in tmp_midedges:
-            self.midedges.insert(0, midedge)
-        for cedge in tmp_cedges:
-            self.coveredges.insert(0, cedge)
-        for cmidedge in tmp_cmidedges:
-            self.covermidedges.insert(0, cmidedge)
+        for line in edge_lines:
+            if line[0:2] == "//":
+                read_line = line[2:]
+                underlying = True
+            else:
+                read_line = line
+                underlying = False
+            tokens = read_line.split()
+            source_id = tokens[0]
+            if '"' in source_id:
+                source_id = source_id[1:-1]
+            if "node" not in source_id and "mid" not in source_id:
+                source_id = "node{}".format(source_id)
+            target_id = tokens[2]
+            if '"' in target_id:
+                target_id = target_id[1:-1]
+            if "node" not in target_id and "mid" not in target_id:
+                target_id = "node{}".format(target_id)
+            source = nodes_by_id.get(sys.intern(source_id))
+            target = nodes_by_id.get(sys.intern(target_id))
+            meshid = get_field("meshid=", read_line, 1)
+            meshid = int(meshid)
+            uses = get_field("uses=", read_line, 1)
+            uses = int(uses)
+            color = get_field("color=", read_line, "black")
+            if "label=" in line:
+                labelcarrier = True
+            else:
+                labelcarrier = False
+            if self.precedenceonly == False:
+                if self.meshedgraph == False:
+                    if "color=grey" in line:
+                        edgetype = "conflict"
+                    else:
+                        edgetype = "causal"
+                elif self.meshedgraph == True:
+                    if "style=dotted" in line:
+                        edgetype = "conflict"
+                    else:
+                        edgetype = "causal"
+            else:
+                edgetype = "precedence"
+            if "rev=True" in line:
+               rev = True
+               source_save = source
+               source = target
+               target = source_save
+            else:
+               rev = False
+            source_is_mid = isinstance(source, MidNode)
+            target_is_mid = isinstance(target, MidNode)
+            if source_is_mid or target_is_mid:
+                new_edge = MidEdge(source, target, uses=uses,
+                                   relationtype=edgetype, reverse=rev,
+                                   meshid=meshid, underlying=underlying,
+                                   color=color, labelcarrier=labelcarrier)
+                if 'cover="True"' not in line:
+                    tmp_midedges.append(new_edge)
+                elif 'cover="True"' in line:
+                    tmp_cmidedges.append(new_edge)
+            else:
+                new_edge = CausalEdge(source, target, uses=uses,
+                                      relationtype=edgetype, meshid=meshid,
+                                      underlying=underlying, color=color)
+                if 'cover="True"' not in line:
+                    tmp_edges.append(new_edge)
+                elif 'cover="True"' in line:
+                    tmp_cedges.append(new_edge)
+        # Edges are stored in the reverse order of the file.
+        self.causaledges = tmp_edges[::-1] + self.causaledges
+        self.midedges = tmp_midedges[::-1] + self.midedges
+        self.coveredges = tmp_cedges[::-1] + self.coveredges
+        self.covermidedges = tmp_cmidedges[::-1] + self.covermidedges
+        self.build_adjacency()
         self.postprocess()
 
 
+    def build_adjacency(self):
+        """ Index causal edges by their source and by their target node. """
+
+        self.in_edges = {}
+        self.out_edges = {}
+        for edge in self.causaledges:
+            self.out_edges.setdefault(edge.source, []).append(edge)
+            self.in_edges.setdefault(edge.target, []).append(edge)
+
+
     def postprocess(self):
         """
         Various stuff to do after reading a dot file. Includes the creation
@@ -753,36 +838,43 @@ class CausalGraph(object):
                  C  D
         """
 
-        edgescopy = self.causaledges.copy()
-        midedgescopy = self.midedges.copy()
-        all_edges = edgescopy + midedgescopy
-        while len(all_edges) > 0:
-            current_group = [all_edges[0]]
-            del(all_edges[0])
-            new_edge_found = True
-            while new_edge_found == True:
-                # Find sources and targets:
-                sources = []
-                targets = []
-                for current_edge in current_group:
-                    if current_edge.source not in sources:
-                        sources.append(current_edge.source)
-                    if current_edge.target not in targets:
-                        targets.append(current_edge.target)
-                # Find other edges with same source or target.
-                new_edge_found = False
-                copy_to_remove = []
-                for i in range(len(all_edges)):
-                    other_source = all_edges[i].source
-                    other_target = all_edges[i].target
-                    if other_source in sources or other_target in targets:
-                        new_edge_found = True
-                        current_group.append(all_edges[i])
-                        copy_to_remove.insert(0, i)
-                for i in copy_to_remove:
-                    del(all_edges[i])
-                if new_edge_found == False:
-                    self.edgegroups.append(current_group)
+        # Index edge positions by source and by target, then grow each group
+        # one layer of edges at a time, taking each layer in list order.
+        all_edges = self.causaledges + self.midedges
+        by_source = {}
+        by_target = {}
+        for i in range(len(all_edges)):
+            by_source.setdefault(all_edges[i].source, []).append(i)
+            by_target.setdefault(all_edges[i].target, []).append(i)
+        grouped = [False] * len(all_edges)
+        seen_sources = set()
+        seen_targets = set()
+        for first in range(len(all_edges)):
+            if grouped[first] == True:
+                continue
+            grouped[first] = True
+            current_group = [all_edges[first]]
+            new_positions = [first]
+            while len(new_positions) > 0:
+                # Find other edges with same source or target as the edges
+                # found last.
+                found = set()
+                for i in new_positions:
+                    source = all_edges[i].source
+                    target = all_edges[i].target
+                    if source not in seen_sources:
+                        seen_sources.add(source)
+                        found.update(by_source[source])
+                    if target not in seen_targets:
+                        seen_targets.add(target)
+                        found.update(by_target[target])
+                new_positions = []
+                for j in sorted(found):
+                    if grouped[j] == False:
+                        grouped[j] = True
+                        current_group.append(all_edges[j])
+                        new_positions.append(j)
+            self.edgegroups.append(current_group)
 
 
     def create_meshes(self, edgegroups, startid):
@@ -791,61 +883,47 @@ class CausalGraph(object):
         midid = startid
         for edgegroup in edgegroups:
             new_mesh = Mesh()
-            # Collect all sources and targets.
-            sources = []
-            targets = []
+            # Index the edges of the group by source and by target, which
+            # also collects all sources and targets.
+            outgoing = {}
+            ingoing = {}
             for edge in edgegroup:
-                if edge.source not in sources:
-                    sources.append(edge.source)
-                if edge.target not in targets:
-                    targets.append(edge.target)
+                outgoing.setdefault(edge.source, []).append(edge)
+                ingoing.setdefault(edge.target, []).append(edge)
             # Create intermediary nodes for event nodes with more than one
             # input or output. Also create an edge between those intermediary
             # nodes and the corresponding event nodes. 
-            inv_sources = []
-            for source in sources:
-                outgoing = []
-                for edge in edgegroup:
-                    if edge.source == source:
-                        outgoing.append(edge)
-                if len(outgoing) > 1:
-                    inv_sources.append(source)
+            inv_midnodes = {}
+            for source in outgoing:
+                if len(outgoing[source]) > 1:
                     new_midnode = MidNode("mid{}".format(midid),
-                                          midtype="involvement")
-                    new_midedge = MidEdge(source, new_midnode)
+                                          midtype="involvement",
+                                          checktypes=False)
+                    new_midedge = MidEdge(source, new_midnode,
+                                          checktypes=False)
                     new_mesh.midnodes.append(new_midnode)
                     new_mesh.midedges.append(new_midedge)
+                    inv_midnodes[source] = new_midnode
                     midid += 1
-            ena_targets = []
-            for target in targets:
-                ingoing = []
-                for edge in edgegroup:
-                    if edge.target == target:
-                        ingoing.append(edge)
-                if len(ingoing) > 1:
-                    ena_targets.append(target)
+            ena_midnodes = {}
+            for target in ingoing:
+                if len(ingoing[target]) > 1:
                     new_midnode = MidNode("mid{}".format(midid),
-                                          midtype="enabling")
-                    new_midedge = MidEdge(new_midnode, target)
+                                          midtype="enabling",
+                                          checktypes=False)
+                    new_midedge = MidEdge(new_midnode, target,
+                                          checktypes=False)
                     new_mesh.midnodes.append(new_midnode)
                     new_mesh.midedges.append(new_midedge)
+                    ena_midnodes[target] = new_midnode
                     midid += 1
             # Add the intermediary edges corresponding to the original edges.
             for ori_edge in edgegroup:
-                if ori_edge.source in inv_sources:
-                    for midedge in new_mesh.midedges:
-                        if midedge.source == ori_edge.source:
-                            s = midedge.target
-                else:
-                    s = ori_edge.source
-                if ori_edge.target in ena_targets:
-                    for midedge in new_mesh.midedges:
-                        if midedge.target == ori_edge.target:
-                            t = midedge.source
-                else:
-                    t = ori_edge.target
+                s = inv_midnodes.get(ori_edge.source, ori_edge.source)
+                t = ena_midnodes.get(ori_edge.target, ori_edge.target)
                 reltype = ori_edge.relationtype
-                new_mesh.midedges.append(MidEdge(s, t, relationtype=reltype))
+                new_mesh.midedges.append(MidEdge(s, t, relationtype=reltype,
+                                                 checktypes=False))
             new_mesh.uses = edgegroup[0].uses
             new_mesh.weight = edgegroup[0].uses
             self.meshes.append(new_mesh)
@@ -863,40 +941,37 @@ class CausalGraph(object):
             worknodes = self.covermidnodes
             workedges = self.covermidedges
             workgroups = self.covermidnodegroups
-        midnodescopy = worknodes.copy()
-        while len(midnodescopy) > 0:
-            current_group = [midnodescopy[0]]
-            del(midnodescopy[0])
-            new_midnode_found = True
-            while new_midnode_found == True:
-                new_midnode_found = False
-                # Find midnodes connected to current midnodes through midedges.
-                midnodes_to_add = []
-                for current_midnode in current_group:
-                    for midedge in workedges:
-                        if midedge.source == current_midnode:
-                            if isinstance(midedge.target, MidNode):
-                                if midedge.target not in current_group:
-                                    if midedge.target not in midnodes_to_add:
-                                        midnodes_to_add.append(midedge.target)
-                                        new_midnode_found = True
-                        if midedge.target == current_midnode:
-                            if isinstance(midedge.source, MidNode):
-                                if midedge.source not in current_group:
-                                    if midedge.source not in midnodes_to_add:
-                                        midnodes_to_add.append(midedge.source)
-                                        new_midnode_found = True
-                for midnode_to_add in midnodes_to_add:
-                    current_group.append(midnode_to_add)
-                # Remove midnodes from midnodescopy.
-                copy_to_remove = []
-                for i in range(len(midnodescopy)):
-                    if midnodescopy[i] in midnodes_to_add:
-                        copy_to_remove.insert(0, i)
-                for i in copy_to_remove:
-                    del(midnodescopy[i])
-                if new_midnode_found == False:
-                    workgroups.append(current_group)
+        # Index midedges by the nodes they touch, keeping midedge order,
+        # then grow each group breadth-first from a queue of midnodes.
+        incident = {}
+        for midedge in workedges:
+            incident.setdefault(midedge.source, []).append(midedge)
+            if midedge.target != midedge.source:
+                incident.setdefault(midedge.target, []).append(midedge)
+        grouped = set()
+        for midnode in worknodes:
+            if midnode in grouped:
+                continue
+            grouped.add(midnode)
+            current_group = [midnode]
+            queue = collections.deque(current_group)
+            while len(queue) > 0:
+                current_midnode = queue.popleft()
+                # Find midnodes connected to current midnode through midedges.
+                for midedge in incident.get(current_midnode, []):
+                    if midedge.source == current_midnode:
+                        if midedge.target.kind == "mid":
+                            if midedge.target not in grouped:
+                                grouped.add(midedge.target)
+                                current_group.append(midedge.target)
+                                queue.append(midedge.target)
+                    if midedge.target == current_midnode:
+                        if midedge.source.kind == "mid":
+                            if midedge.source not in grouped:
+                                grouped.add(midedge.source)
+                                current_group.append(midedge.source)
+                                queue.append(midedge.source)
+            workgroups.append(current_group)
 
 
     def read_meshes(self, cover=False):
@@ -912,17 +987,21 @@ class CausalGraph(object):
             workedges = self.covermidedges
             workmeshes = self.covermeshes
             workcausal = self.coveredges
+        # Index midedges by the nodes they touch, keeping midedge order.
+        incident = {}
+        for midedge in workedges:
+            incident.setdefault(midedge.source, []).append(midedge)
+            if midedge.target != midedge.source:
+                incident.setdefault(midedge.target, []).append(midedge)
         for midnodegroup in workgroups:
             new_mesh = Mesh()
+            added_midedges = set()
             for midnode in midnodegroup:
                 new_mesh.midnodes.append(midnode)
-                for midedge in workedges:
-                    if midedge.source == midnode:
-                        if midedge not in new_mesh.midedges:
-                            new_mesh.midedges.append(midedge)
-                    if midedge.target == midnode:
-                        if midedge not in new_mesh.midedges:
-                            new_mesh.midedges.append(midedge)
+                for midedge in incident.get(midnode, []):
+                    if midedge not in added_midedges:
+                        new_mesh.midedges.append(midedge)
+                        added_midedges.add(midedge)
             new_mesh.uses = new_mesh.midedges[0].uses
             new_mesh.weight = new_mesh.midedges[0].uses
             new_mesh.meshid = new_mesh.midedges[0].meshid
@@ -945,9 +1024,8 @@ class CausalGraph(object):
         for node in self.eventnodes:
             if node.intro == False:
                 incoming_nodes = []
-                for edge in self.causaledges:
-                    if edge.target == node:
-                        incoming_nodes.append(edge.source)
+                for edge in self.in_edges.get(node, []):
+                    incoming_nodes.append(edge.source)
                 all_intro = True
                 for incoming_node in incoming_nodes:
                     if incoming_node.intro == False:
@@ -971,73 +1049,99 @@ class CausalGraph(object):
                 current_nodes.append(node)
             else:
                 node.rank = None
+        # Index meshes by their event sources and targets. Meshes do not
+        # change while ranking, so their events are computed only once.
+        mesh_events = {}
+        source_meshes = {}
+        target_meshes = {}
+        for mesh in self.meshes:
+            mesh_sources, mesh_targets = mesh.get_events()
+            mesh_events[mesh] = (mesh_sources, mesh_targets)
+            for mesh_source in mesh_sources:
+                source_meshes.setdefault(mesh_source, []).append(mesh)
+            for mesh_target in mesh_targets:
+                target_meshes.setdefault(mesh_target, []).append(mesh)
+        # For each target of each mesh, keep its non-intro sources and a
+        # counter of those that are not ranked yet, in the manner of the
+        # in-degree counters of a topological sort. A target is secured in
+        # a mesh when its counter drops to zero. The highest rank among
+        # its ranked sources is also kept up to date as nodes get ranked.
+        enablings = {}
+        unranked = {}
+        top_rank = {}
+        waiting = {}
+        for mesh in self.meshes:
+            mesh_sources, mesh_targets = mesh_events[mesh]
+            for mesh_target in mesh_targets:
+                key = (mesh, mesh_target)
+                tmp_sources = mesh.get_sources(mesh_target)
+                key_sources = []
+                for node in tmp_sources:
+                    if node.intro == False:
+                        key_sources.append(node)
+                enablings[key] = len(key_sources)
+                unranked[key] = 0
+                top_rank[key] = 0
+                for node in key_sources:
+                    if node.rank == None:
+                        unranked[key] += 1
+                        waiting.setdefault(node, []).append(key)
+                    elif node.rank > top_rank[key]:
+                        top_rank[key] = node.rank
+        # Gather all the targets of the meshes going out of each node.
+        out_targets = {}
+        for node in source_meshes:
+            node_targets = set()
+            for mesh in source_meshes[node]:
+                mesh_sources, mesh_targets = mesh_events[mesh]
+                node_targets.update(mesh_targets)
+            out_targets[node] = node_targets
         while len(current_nodes) > 0:
             # 1) Gather meshes that have a current_node in their sources.
-            current_meshes = []
-            for mesh in self.meshes:
-                mesh_sources, mesh_targets = mesh.get_events()
-                for current_node in current_nodes:
-                    if current_node in mesh_sources:
-                        if mesh not in current_meshes:
-                            current_meshes.append(mesh)
+            current_set = set()
+            for current_node in current_nodes:
+                current_set.update(source_meshes.get(current_node, []))
             # 2) Gather candidate nodes as any target of current meshes
             #    that is not ranked yet.
-            candidates = []
-            for mesh in current_meshes:
-                mesh_sources, mesh_targets = mesh.get_events()
-                for mesh_target in mesh_targets:
-                    if mesh_target.rank == None:
-                        if mesh_target not in candidates:
-                            candidates.append(mesh_target)
+            candidates = {}
+            for mesh in self.meshes:
+                if mesh in current_set:
+                    mesh_sources, mesh_targets = mesh_events[mesh]
+                    for mesh_target in mesh_targets:
+                        if mesh_target.rank == None:
+                            candidates[mesh_target] = None
             # 3) Set rank of all candidate nodes that are secured: all the
             #    nodes pointing to them (ignoring intro nodes) are already
             #    ranked in at least one edge group.
             for candidate in candidates:
                 possible_ranks = []
-                for mesh in current_meshes:
-                    tmp_sources = mesh.get_sources(candidate)
-                    mesh_sources = []
-                    for node in tmp_sources:
-                        if node.intro == False:
-                            mesh_sources.append(node)
-                    if len(mesh_sources) > 0:
-                        secured = True
-                        for mesh_source in mesh_sources:
-                            if mesh_source.rank == None:
-                                secured = False
-                                break
-                        if secured == True:
-                            source_ranks = []
-                            for mesh_source in mesh_sources:
-                                source_ranks.append(mesh_source.rank)
-                            possible_ranks.append(max(source_ranks)+1)
+                for mesh in target_meshes[candidate]:
+                    if mesh not in current_set:
+                        continue
+                    key = (mesh, candidate)
+                    if enablings[key] > 0 and unranked[key] == 0:
+                        possible_ranks.append(top_rank[key]+1)
                 if len(possible_ranks) > 0:
                     candidate.rank = min(possible_ranks)
                     current_nodes.append(candidate)
+                    for key in waiting.get(candidate, []):
+                        unranked[key] -= 1
+                        if candidate.rank > top_rank[key]:
+                            top_rank[key] = candidate.rank
             # 4) Remove all current_nodes for which all outgoing meshes
             #    have all their targets already ranked.
             next_nodes = []
             for current_node in current_nodes:
-                keep_node = False
-                node_targets = []
-                for mesh in self.meshes:
-                    mesh_sources, mesh_targets = mesh.get_events()
-                    if current_node in mesh_sources:
-                        for mesh_target in mesh_targets:
-                            if mesh_target not in node_targets:
-                                node_targets.append(mesh_target)
-                for node in node_targets:
+                for node in out_targets.get(current_node, []):
                     if node.rank == None:
-                        keep_node = True
+                        next_nodes.append(current_node)
                         break
-                if keep_node == True:
-                    next_nodes.append(current_node)
             current_nodes = next_nodes
         # Rank intro nodes as the lowest rank of a node it points to minus one.
         for node in self.eventnodes:
             if node.intro == True:
                 target_ranks = []
-                for mesh in self.meshes:
+                for mesh in source_meshes.get(node, []):
                     mesh_targets = mesh.get_targets(node)
                     for mesh_target in mesh_targets:
                         target_ranks.append(mesh_target.rank)
@@ -1119,23 +1223,26 @@ class CausalGraph(object):
     def get_maxrank(self):
         """ Find the highest rank of a node in CausalGraph. """
 
-        all_ranks = []
-        for node in self.eventnodes:
-            if node.rank != None:
-                all_ranks.append(node.rank)
-        if len(all_ranks) > 0:
-            self.maxrank = max(all_ranks)
+        # Keep the previous maxrank if no node is ranked.
+        self.maxrank = max((node.rank for node in self.eventnodes
+                            if node.rank != None), default=self.maxrank)
 
 
     def sequentialize_nodeids(self):
         """ Assign sequential node ids, getting rid of event numbers. """
 
+        # Number nodes by rank, then by list order within a rank. Only nodes
+        # with a whole rank between 0 and maxrank are numbered.
+        ranked_nodes = []
+        for node in self.eventnodes:
+            if node.rank != None:
+                if node.rank%1 == 0 and 0 <= node.rank <= self.maxrank:
+                    ranked_nodes.append(node)
+        ranked_nodes.sort(key=lambda x: x.rank)
         node_number = 1
-        for current_rank in range(self.maxrank+1):
-            for node in self.eventnodes:
-                if node.rank == current_rank:
-                    node.nodeid = "node{}".format(node_number)
-                    node_number += 1
+        for node in ranked_nodes:
+            node.nodeid = "node{}".format(node_number)
+            node_number += 1
         # Also sort causal edges.
         # (Not needed, only sort grouped edges before building the dot file).
         #sorted_edges = sorted(self.causaledges, key=lambda x: x.source.rank)
@@ -1154,6 +1261,15 @@ class CausalGraph(object):
         self.covermeshes = []
         nointro_groups = []
         midid = self.find_max_midid()+1
+        # Only meshes of the same color are compared, so bucket them first.
+        meshes_by_color = {}
+        for mesh in self.meshes:
+            meshes_by_color.setdefault(mesh.color, []).append(mesh)
+        # Group the meshes of a color by the signature of their version
+        # without intro nodes, the first time that color is needed. Midnode
+        # ids do not matter for the signature.
+        signature_groups = {}
+        grouped_colors = set()
         for mesh1 in self.meshes:
             mesh_list = []
             if mesh1.underlying == False:
@@ -1165,20 +1281,25 @@ class CausalGraph(object):
                         mesh_list.append(mesh1)
                         noin1 = self.nointro_mesh(mesh1, midid)
                         midid += len(noin1.midnodes)
+                        signature1 = self.mesh_signature(noin1)
                         if len(noin1.midedges) > 0:
                             # Check all other meshes that have the same
                             # midedges when ignoring edges with intro nodes as
                             # source. They will all be grouped inside a single
                             # mesh without intro nodes as sources.
-                            for mesh2 in self.meshes:
-                                if mesh2.color == mesh1.color:
-                                    if mesh2 != mesh1:
-                                        if mesh2.underlying == False:
-                                            noin2 = self.nointro_mesh(mesh2,
-                                                                      midid)
-                                            if self.equivalent_meshes(noin1,
-                                                                      noin2):
-                                                mesh_list.append(mesh2)
+                            color = mesh1.color
+                            if color not in grouped_colors:
+                                grouped_colors.add(color)
+                                for mesh2 in meshes_by_color[color]:
+                                    noin2 = self.nointro_mesh(mesh2, midid)
+                                    key = (color, self.mesh_signature(noin2))
+                                    if key not in signature_groups:
+                                        signature_groups[key] = []
+                                    signature_groups[key].append(mesh2)
+                            for mesh2 in signature_groups[(color, signature1)]:
+                                if mesh2 != mesh1:
+                                    if mesh2.underlying == False:
+                                        mesh_list.append(mesh2)
             if len(mesh_list) > 0:
                 # Compute occurence of nointro mesh as the sum of all its
                 # underlying meshes. Also mark meshes that were used as
@@ -1229,11 +1350,14 @@ class CausalGraph(object):
         has_intro = False
         all_intro = True
         for midedge in mesh.midedges:
-            if isinstance(midedge.source, EventNode):
+            if midedge.source.kind == "event":
                 if midedge.source.intro == True:
                     has_intro = True
                 if midedge.source.intro == False:
                     all_intro = False
+                # Neither answer can change past this point.
+                if has_intro == True and all_intro == False:
+                    break
 
         return has_intro, all_intro
 
@@ -1247,16 +1371,17 @@ class CausalGraph(object):
         """
 
         new_mesh = Mesh(uses=mesh.uses, color=mesh.color)
-        # Add midnodes with temporary ids.
+        # Add midnodes with temporary ids, indexed by the id of the midnode
+        # they copy.
         tmpid = 1
-        tmpid_map = {}
+        new_midnodes = {}
         for midnode in mesh.midnodes:
             new_mesh.midnodes.append(MidNode("mid{}".format(tmpid),
                                              midtype=midnode.midtype))
             new_mesh.midnodes[-1].bordercolor = midnode.bordercolor
             if midnode.midtype == "enabling":
                 new_mesh.midnodes[-1].fillcolor = midnode.fillcolor
-            tmpid_map["mid{}".format(tmpid)] = midnode.nodeid
+            new_midnodes[midnode.nodeid] = new_mesh.midnodes[-1]
             tmpid += 1
         # Add the midedges that do not have an intro node as source.
         for midedge in mesh.midedges:
@@ -1269,41 +1394,41 @@ class CausalGraph(object):
                 if isinstance(midedge.source, EventNode):
                     s = midedge.source
                 elif isinstance(midedge.source, MidNode):
-                    for new_node in new_mesh.midnodes:
-                        if tmpid_map[new_node.nodeid] == midedge.source.nodeid:
-                            s = new_node
+                    s = new_midnodes[midedge.source.nodeid]
                 # Get target.
                 if isinstance(midedge.target, EventNode):
                     t = midedge.target
                 elif isinstance(midedge.target, MidNode):
-                    for new_node in new_mesh.midnodes:
-                        if tmpid_map[new_node.nodeid] == midedge.target.nodeid:
-                            t = new_node
+                    t = new_midnodes[midedge.target.nodeid]
                 use = midedge.uses
                 rel = midedge.relationtype
                 col = midedge.color
                 new_mesh.midedges.append(MidEdge(s, t, uses=use,
                                                  relationtype=rel, color=col))
+        # Index the new midedges by source and by target.
+        out_by_source = {}
+        in_by_target = {}
+        for midedge in new_mesh.midedges:
+            out_by_source.setdefault(midedge.source, []).append(midedge)
+            in_by_target.setdefault(midedge.target, []).append(midedge)
         # Treat involvement nodes that have no incoming edge from an event
         # node as ghost nodes.
         for midnode in new_mesh.midnodes:
             if midnode.midtype == "involvement":
                 has_incoming = False
-                for midedge in new_mesh.midedges:
-                    if midedge.target == midnode:
-                        if isinstance(midedge.source, EventNode):
-                            has_incoming = True
-                            break
+                for midedge in in_by_target.get(midnode, []):
+                    if isinstance(midedge.source, EventNode):
+                        has_incoming = True
+                        break
                 if has_incoming == False:
                     midnode.ghost = True
         # Remove enablings if they have only one incoming edge and one
         # outgoing edge once intro nodes were removed. Replace the incoming
         # and outgoing edges by a single edge.
-        enas_to_remove = []
-        midedges_to_remove = []
+        enas_to_remove = set()
+        midedges_to_remove = set()
         midedges_to_add = []
-        for i in range(len(new_mesh.midnodes)):
-            midnode = new_mesh.midnodes[i]
+        for midnode in new_mesh.midnodes:
             if midnode.midtype == "enabling":
                 # Keep midnode if it is found in connectors.
                 #connected = False
@@ -1311,24 +1436,14 @@ class CausalGraph(object):
                 #    if connect.source == midnode or connect.source == midnode:
                 #        connected = True
                 #if connected == False or connected == True:
-                incoming_count = 0
-                outgoing_count = 0
-                for midedge in new_mesh.midedges:
-                    if midedge.target == midnode:
-                        incoming_count += 1
-                        in_edge = midedge
-                    if midedge.source == midnode:
-                        outgoing_count += 1
-                        out_edge = midedge
-                if incoming_count == 1 and outgoing_count == 1:
-                    enas_to_remove.insert(0, i)
-                    for j in range(len(new_mesh.midedges)):
-                        if new_mesh.midedges[j].source == midnode:
-                            if j not in midedges_to_remove:
-                                midedges_to_remove.append(j)
-                        if new_mesh.midedges[j].target == midnode:
-                            if j not in midedges_to_remove:
-                                midedges_to_remove.append(j)
+                incoming = in_by_target.get(midnode, [])
+                outgoing = out_by_source.get(midnode, [])
+                if len(incoming) == 1 and len(outgoing) == 1:
+                    in_edge = incoming[0]
+                    out_edge = outgoing[0]
+                    enas_to_remove.add(midnode)
+                    midedges_to_remove.add(in_edge)
+                    midedges_to_remove.add(out_edge)
                     use = in_edge.uses
                     rel = in_edge.relationtype
                     midedges_to_add.append(MidEdge(in_edge.source,
@@ -1336,12 +1451,18 @@ class CausalGraph(object):
                                                    uses=use,
                                                    relationtype=rel,
                                                    color=mesh.color))
-        for j in sorted(midedges_to_remove, reverse=True):
-            del(new_mesh.midedges[j])
-        for i in enas_to_remove:
-            del(new_mesh.midnodes[i])
+        kept_midedges = []
+        for midedge in new_mesh.midedges:
+            if midedge not in midedges_to_remove:
+                kept_midedges.append(midedge)
         for midedge in midedges_to_add:
-            new_mesh.midedges.append(midedge)
+            kept_midedges.append(midedge)
+        new_mesh.midedges = kept_midedges
+        kept_midnodes = []
+        for midnode in new_mesh.midnodes:
+            if midnode not in enas_to_remove:
+                kept_midnodes.append(midnode)
+        new_mesh.midnodes = kept_midnodes
         # Reassign intermediary node ids in case some were removed.
         for midnode in new_mesh.midnodes:
             midnode.nodeid = "mid{}".format(midid)
@@ -1373,7 +1494,9 @@ class CausalGraph(object):
                 are_same = True
             else:
                 are_same = False
-        if are_same == True:
+        # Without midnodes, all midedges go from event to event and none of
+        # them is kept by extend_midedges, the events are enough.
+        if are_same == True and nn1 > 0:
             neighbors1 = mesh1.extend_midedges()
             neighbors2 = mesh2.extend_midedges()
             equi_midedges = self.equivalent_midedges(neighbors1, neighbors2)
@@ -1385,47 +1508,34 @@ class CausalGraph(object):
         return are_same
 
 
+    def mesh_signature(self, mesh):
+        """
+        Return a key that is the same for two meshes exactly when
+        equivalent_meshes finds them equivalent. The cheapest invariants come
+        first, so comparing keys rejects most pairs early.
+        """
+
+        sources, targets = mesh.get_events()
+        if len(mesh.midnodes) > 0:
+            midedge_keys = neighbor_keys(mesh.extend_midedges())
+        else:
+            midedge_keys = frozenset()
+        signature = (len(mesh.midnodes), len(mesh.midedges),
+                     frozenset(sources), frozenset(targets), midedge_keys)
+
+        return signature
+
+
     def equivalent_midedges(self, neighbors1, neighbors2):
         """
         Find whether two lists of midedges (described as their respective
         neighbors) connect to the same event nodes.
         """
  
-        list1 = neighbors1.copy()
-        list2 = neighbors2.copy()
-        found1 = []
-        found2 = []
-        for i in range(len(list1)):
-            s1 = list1[i]["srcs"]
-            t1 = list1[i]["trgs"]
-            for j in range(len(list2)):
-                s2 = list2[j]["srcs"]
-                t2 = list2[j]["trgs"]
-                if list1[i]["reltype"] == list2[j]["reltype"]:
-                    if same_objects(s1, s2):
-                        if same_objects(t1, t2):
-                            found1.insert(0, i)
-                            break
-        for j in range(len(list2)):
-            s2 = list2[j]["srcs"]
-            t2 = list2[j]["trgs"]
-            for i in range(len(list1)):
-                s1 = list1[i]["srcs"]
-                t1 = list1[i]["trgs"]
-                if list2[j]["reltype"] == list1[i]["reltype"]:
-                    if same_objects(s2, s1):
-                        if same_objects(t2, t1):
-                            found2.insert(0, j)
-                            break
-        for i in found1:
-            del(list1[i])
-        for j in found2:
-            del(list2[j])
-        if len(list1) == 0 and len(list2) == 0:
-            are_same = True
-        else:
-            are_same = False
- 
+        # Each midedge matches any midedge with the same relation type and
+        # the same sets of sources and targets.
+        are_same = neighbor_keys(neighbors1) == neighbor_keys(neighbors2)
+
         return are_same
 
 
@@ -1629,25 +1739,27 @@ class CausalGraph(object):
         """ build a dot file of the CausalGraph. """
 
         # Write info about graph.
-        dot_str = 'digraph G{\n'
-        dot_str += '  precedenceonly="{}" ;\n'.format(self.precedenceonly)
-        dot_str += '  meshedgraph="{}" ;\n'.format(self.meshedgraph)
-        dot_str += '  nodestype="{}" ;\n'.format(self.nodestype)
+        dot_parts = ['digraph G{\n']
+        dot_parts.append('  precedenceonly="{}" ;\n'
+                         .format(self.precedenceonly))
+        dot_parts.append('  meshedgraph="{}" ;\n'.format(self.meshedgraph))
+        dot_parts.append('  nodestype="{}" ;\n'.format(self.nodestype))
         if self.eoi != None:
-            dot_str += '  eoi="{}" ;\n'.format(self.eoi)
+            dot_parts.append('  eoi="{}" ;\n'.format(self.eoi))
         if self.occurrence != None:
-            dot_str += '  label="Occurrence = {}" '.format(self.occurrence)
-            dot_str += 'fontsize=28 labelloc="t" ;\n'
+            dot_parts.append('  label="Occurrence = {}" '
+                             .format(self.occurrence))
+            dot_parts.append('fontsize=28 labelloc="t" ;\n')
         if self.maxrank != None:
-            dot_str += '  maxrank="{}" ;\n'.format(self.maxrank)
+            dot_parts.append('  maxrank="{}" ;\n'.format(self.maxrank))
         if self.prevcores != None:
-            dot_str += '  prevcores="{}" ;\n'.format(self.prevcores)
-        #dot_str += '  ranksep=0.5 ;\n'
-        #dot_str += '  nodesep=0.2 ;\n' # Default nodesep is 0.25
-        dot_str += '  splines=true ;\n'
-        dot_str += '  outputorder=nodesfirst ;\n'
-        dot_str += '  node [pin=true] ;\n'
-        #dot_str += '  edge [fontsize=18] ;\n'
+            dot_parts.append('  prevcores="{}" ;\n'.format(self.prevcores))
+        #dot_parts.append('  ranksep=0.5 ;\n')
+        #dot_parts.append('  nodesep=0.2 ;\n') # Default nodesep is 0.25
+        dot_parts.append('  splines=true ;\n')
+        dot_parts.append('  outputorder=nodesfirst ;\n')
+        dot_parts.append('  node [pin=true] ;\n')
+        #dot_parts.append('  edge [fontsize=18] ;\n')
         # Compute some statistics to assign edge and intermediary node width.
         minpenwidth = 1
         medpenwidth = 3
@@ -1658,118 +1770,133 @@ class CausalGraph(object):
                 all_uses.append(mesh.uses)
         for covermesh in self.covermeshes:
             all_uses.append(covermesh.uses)
-        average_use = statistics.mean(all_uses)
+        average_use = statistics.fmean(all_uses)
+        # The pen size only depends on the mesh, compute it once per mesh.
+        pensizes = {}
+        for mesh in self.meshes:
+            pensizes[mesh] = self.mesh_pensize(mesh, average_use, minpenwidth,
+                                               medpenwidth, maxpenwidth)
+        if showintro == False:
+            for covermesh in self.covermeshes:
+                pensizes[covermesh] = self.mesh_pensize(covermesh,
+                    average_use, minpenwidth, medpenwidth, maxpenwidth)
+        # Bucket nodes and midnodes by rank, keeping their order.
+        nodes_by_rank = {}
+        for node in self.eventnodes:
+            nodes_by_rank.setdefault(node.rank, []).append(node)
+        midnodes_by_rank = {}
+        for mesh in self.meshes:
+            for midnode in mesh.midnodes:
+                midnodes_by_rank.setdefault(midnode.rank, []).append(
+                    (mesh, midnode))
+        # Cover midnodes are only drawn if showintro is False.
+        covermids_by_rank = {}
+        if showintro == False:
+            for covermesh in self.covermeshes:
+                for midnode in covermesh.midnodes:
+                    covermids_by_rank.setdefault(midnode.rank, []).append(
+                        (covermesh, midnode))
         # Draw nodes.
         midranks = 1
         for int_rank in range((self.maxrank+1)*(midranks+1)):
             current_rank = int_rank/(midranks+1)
             rank_str = "{}".format(current_rank)
             if showintro == False and current_rank < 1:
-                dot_str += "//"
+                dot_parts.append("//")
             if current_rank%1 == 0:
                 rank_str = str(int(current_rank))
-                dot_str += ('{{ rank = same ; "{}" ['
-                            'shape=plaintext'.format(rank_str))
+                dot_parts.append('{{ rank = same ; "{}" ['
+                                 'shape=plaintext'.format(rank_str))
                 if self.rankposdict != None:
                     if rank_str in self.rankposdict.keys():
                         rankpos = self.rankposdict[rank_str]
-                        dot_str += ', pos={}'.format(rankpos)
-                dot_str +='];\n'
+                        dot_parts.append(', pos={}'.format(rankpos))
+                dot_parts.append('];\n')
             else:
                 rank_str = "{:.2f}".format(current_rank)
-                dot_str += ('{{ rank = same ; "{}" [label="", '
-                            'shape=plaintext'.format(rank_str))
+                dot_parts.append('{{ rank = same ; "{}" [label="", '
+                                 'shape=plaintext'.format(rank_str))
                 if self.rankposdict != None:
                     if rank_str in self.rankposdict.keys():
                         rankpos = self.rankposdict[rank_str]
-                        dot_str += ', pos={}'.format(rankpos)
-                dot_str += '];\n'
-            for node in self.eventnodes:
-                if node.rank == current_rank:
-                    #node_shape = 'invhouse'
+                        dot_parts.append(', pos={}'.format(rankpos))
+                dot_parts.append('];\n')
+            for node in nodes_by_rank.get(current_rank, []):
+                #node_shape = 'invhouse'
+                node_shape = 'rectangle'
+                node_color = 'lightblue'
+                if node.intro == True:
                     node_shape = 'rectangle'
-                    node_color = 'lightblue'
-                    if node.intro == True:
-                        node_shape = 'rectangle'
-                        node_color = 'white'
-                    if node.label == self.eoi:
-                        node_shape = 'ellipse'
-                        node_color = 'indianred2'
-                    if self.nodestype == 'species':
-                        node_shape = 'ellipse'
-                    if showintro == False and node.intro == True:
-                        dot_str += '//'
-                    node_lines = textwrap.wrap(node.label, 20,
-                                              break_long_words=False)
-                    node_str = ""
-                    for i in range(len(node_lines)):
-                        if i == 0:
-                            node_str += " {} ".format(node_lines[i])
-                        else:
-                            node_str += "\\n {} ".format(node_lines[i])
-                    dot_str += ('"{}" [label="{}"'
-                                .format(node.nodeid, node_str))
-                    dot_str += ', shape={}, style=filled'.format(node_shape)
-                    if node.highlighted == True:
-                       dot_str += ', fillcolor=gold, penwidth=2'
+                    node_color = 'white'
+                if node.label == self.eoi:
+                    node_shape = 'ellipse'
+                    node_color = 'indianred2'
+                if self.nodestype == 'species':
+                    node_shape = 'ellipse'
+                if showintro == False and node.intro == True:
+                    dot_parts.append('//')
+                node_lines = textwrap.wrap(node.label, 20,
+                                          break_long_words=False)
+                node_str = ""
+                for i in range(len(node_lines)):
+                    if i == 0:
+                        node_str += " {} ".format(node_lines[i])
                     else:
-                       dot_str += ', fillcolor={}'.format(node_color)
-                    if node.intro == True:
-                        dot_str += ', intro={}'.format(node.intro)
-                    if node.first == True:
-                        dot_str += ', first={}'.format(node.first)
-                    if node.pos != None:
-                        dot_str += ', pos={}'.format(node.pos)
-                    dot_str += "] ;\n"
+                        node_str += "\\n {} ".format(node_lines[i])
+                dot_parts.append('"{}" [label="{}"'
+                                 .format(node.nodeid, node_str))
+                dot_parts.append(', shape={}, style=filled'
+                                 .format(node_shape))
+                if node.highlighted == True:
+                   dot_parts.append(', fillcolor=gold, penwidth=2')
+                else:
+                   dot_parts.append(', fillcolor={}'.format(node_color))
+                if node.intro == True:
+                    dot_parts.append(', intro={}'.format(node.intro))
+                if node.first == True:
+                    dot_parts.append(', first={}'.format(node.first))
+                if node.pos != None:
+                    dot_parts.append(', pos={}'.format(node.pos))
+                dot_parts.append("] ;\n")
             # Draw intermediary nodes that emulate hyperedges if two
             # sources or more are drawn.
-            for mesh in self.meshes:
-                for midnode in mesh.midnodes:
-                    if midnode.rank == current_rank:
-                        # Include the midnode no matter what, but comment it
-                        # if showintro is False and edge is underlying. 
-                        if showintro == False:
-                            if mesh.underlying == True:
-                                dot_str += '//'
-                        dot_str += self.write_midnode(mesh, midnode,
-                            average_use, minpenwidth, medpenwidth, maxpenwidth)
-                        dot_str += '] ;\n'
+            for mesh, midnode in midnodes_by_rank.get(current_rank, []):
+                # Include the midnode no matter what, but comment it
+                # if showintro is False and edge is underlying. 
+                if showintro == False:
+                    if mesh.underlying == True:
+                        dot_parts.append('//')
+                dot_parts.append(self.write_midnode(mesh, midnode,
+                                                    pensizes[mesh]))
+                dot_parts.append('] ;\n')
             # Intermediary nodes from cover edges, same as above but only
             # if showintro is False.
-            if showintro == False:
-                for covermesh in self.covermeshes:
-                    for midnode in covermesh.midnodes:
-                        if midnode.rank == current_rank:
-                            dot_str += self.write_midnode(covermesh, midnode,
-                                average_use, minpenwidth, medpenwidth, maxpenwidth)
-                            dot_str += ', cover="True"] ;\n'
+            for covermesh, midnode in covermids_by_rank.get(current_rank, []):
+                dot_parts.append(self.write_midnode(covermesh, midnode,
+                                                    pensizes[covermesh]))
+                dot_parts.append(', cover="True"] ;\n')
             # Close rank braces.
             if showintro == False and current_rank < 1:
-                dot_str += "//"
-            dot_str += "}\n"
+                dot_parts.append("//")
+            dot_parts.append("}\n")
         # Draw unranked midnodes.
-        for mesh in self.meshes:
-            for midnode in mesh.midnodes:
-                if midnode.rank == None:
-                    # Include the midnode no matter what, but comment it
-                    # if showintro is False and edge is underlying. 
-                    if showintro == False and mesh.underlying == True:
-                        dot_str += '//'
-                    dot_str += self.write_midnode(mesh, midnode, average_use,
-                        minpenwidth, medpenwidth, maxpenwidth)
-                    dot_str += '] ;\n'
-        if showintro == False:
-            for covermesh in self.covermeshes:
-                for midnode in covermesh.midnodes:
-                    if midnode.rank == None:
-                        dot_str += self.write_midnode(covermesh, midnode,
-                            average_use, minpenwidth, medpenwidth, maxpenwidth)
-                        dot_str += ', cover="True"] ;\n'
+        for mesh, midnode in midnodes_by_rank.get(None, []):
+            # Include the midnode no matter what, but comment it
+            # if showintro is False and edge is underlying. 
+            if showintro == False and mesh.underlying == True:
+                dot_parts.append('//')
+            dot_parts.append(self.write_midnode(mesh, midnode,
+                                                pensizes[mesh]))
+            dot_parts.append('] ;\n')
+        for covermesh, midnode in covermids_by_rank.get(None, []):
+            dot_parts.append(self.write_midnode(covermesh, midnode,
+                                                pensizes[covermesh]))
+            dot_parts.append(', cover="True"] ;\n')
         # Draw invisible ranking edges.
         for int_rank in range(self.maxrank*(midranks+1)):
             rank = int_rank/(midranks+1)
             if showintro == False and rank < 1:
-                dot_str += '//'
+                dot_parts.append('//')
             next_rank = rank+(1.0/(midranks+1))
             if rank%1 == 0:
                 rank_str = '{}'.format(int(rank))
@@ -1779,14 +1906,14 @@ class CausalGraph(object):
                 next_str = '{}'.format(int(next_rank))
             else:
                 next_str = '{:.2f}'.format(next_rank)
-            dot_str += ('"{}" -> "{}" [style="invis"'.format(rank_str,
-                                                             next_str))
+            dot_parts.append('"{}" -> "{}" [style="invis"'
+                             .format(rank_str, next_str))
             if self.rankposdict != None:
                 edge_str = "{} -> {}".format(rank_str, next_str)
                 if edge_str in self.rankposdict.keys():
                     edgerankpos = self.rankposdict[edge_str]
-                    dot_str += ', pos={}'.format(edgerankpos)
-            dot_str += '] ;\n'
+                    dot_parts.append(', pos={}'.format(edgerankpos))
+            dot_parts.append('] ;\n')
         # Draw each intermediary edge found in each mesh. Comment if
         # Underlying. The occurrence of each intermediary edge within
         # a mesh should be the same.
@@ -1794,30 +1921,28 @@ class CausalGraph(object):
             mesh.check_indicators()
             for midedge in mesh.midedges:
                 if showintro == False and mesh.underlying == True:
-                    dot_str += "//"
-                dot_str += self.write_midedge(mesh, midedge, average_use,
-                    minpenwidth, medpenwidth, maxpenwidth, addedgelabels,
-                    showedgelabels, edgeid, edgeocc, edgeuse, statstype,
-                    weightedges)
-                dot_str += '] ;\n'
+                    dot_parts.append("//")
+                dot_parts.append(self.write_midedge(mesh, midedge,
+                    pensizes[mesh], addedgelabels, showedgelabels, edgeid,
+                    edgeocc, edgeuse, statstype, weightedges))
+                dot_parts.append('] ;\n')
         # Draw cover edges if intro nodes are not shown.
         if showintro == False:
             for covermesh in self.covermeshes:
                 covermesh.check_indicators()
                 for midedge in covermesh.midedges:
-                    dot_str += self.write_midedge(covermesh, midedge,
-                        average_use, minpenwidth, medpenwidth, maxpenwidth,
-                        addedgelabels, showedgelabels, edgeid, edgeocc,
-                        edgeuse, statstype, weightedges)
-                    dot_str += ', cover="True"] ;\n'
+                    dot_parts.append(self.write_midedge(covermesh, midedge,
+                        pensizes[covermesh], addedgelabels, showedgelabels,
+                        edgeid, edgeocc, edgeuse, statstype, weightedges))
+                    dot_parts.append(', cover="True"] ;\n')
         # Close graph.
-        dot_str += "}"
-        self.dot_file = dot_str
+        dot_parts.append("}")
+        self.dot_file = "".join(dot_parts)
 
 
-    def write_midnode(self, mesh, midnode, average_use, minpenwidth,
-                      medpenwidth, maxpenwidth):
-        """ Write the line of a dot file for a single midnode."""
+    def mesh_pensize(self, mesh, average_use, minpenwidth, medpenwidth,
+                     maxpenwidth):
+        """ Compute the pen size of a mesh from its uses. """
 
         ratio = mesh.uses/average_use
         pensize = math.log(ratio, 2) + medpenwidth
@@ -1825,6 +1950,13 @@ class CausalGraph(object):
             pensize = minpenwidth
         if pensize > maxpenwidth:
             pensize = maxpenwidth
+
+        return pensize
+
+
+    def write_midnode(self, mesh, midnode, pensize):
+        """ Write the line of a dot file for a single midnode."""
+
         pensize = math.sqrt(pensize)/12
         mid_str = '"{}" [label=""'.format(midnode.nodeid)
         mid_str += ', shape=circle'
@@ -1847,17 +1979,11 @@ class CausalGraph(object):
         return mid_str
 
 
-    def write_midedge(self, mesh, midedge, average_use, minpenwidth,
-                      medpenwidth, maxpenwidth, addedgelabels, showedgelabels,
-                      edgeid, edgeocc, edgeuse, statstype, weightedges):
+    def write_midedge(self, mesh, midedge, pensize, addedgelabels,
+                      showedgelabels, edgeid, edgeocc, edgeuse, statstype,
+                      weightedges):
         """ Write the line of a dot file for a single midedge. """
 
-        ratio = mesh.uses/average_use
-        pensize = math.log(ratio,2) + medpenwidth
-        if pensize < minpenwidth:
-            pensize = minpenwidth
-        if pensize > maxpenwidth:
-            pensize = maxpenwidth
         if midedge.reverse == False:
             mid_str = ('"{}" -> "{}" '.format(midedge.source.nodeid,
                                               midedge.target.nodeid))
@@ -1958,34 +2084,29 @@ class CausalGraph(object):
         return res
 
 
+def neighbor_keys(neighbors):
+    """
+    Describe each midedge from a list of midedge neighbors by its relation
+    type and the sets of its source and target events.
+    """
+
+    keys = set()
+    for neighbor in neighbors:
+        keys.add((neighbor["reltype"], frozenset(neighbor["srcs"]),
+                  frozenset(neighbor["trgs"])))
+
+    return frozenset(keys)
+
+
 def same_objects(list1, list2):
     """
     Find if two lists of objects contain all the same objects.
     (The objects may be found in a different order in the two lists).
     """
 
-    group1 = list1.copy()
-    group2 = list2.copy()
-    found1 = []
-    found2 = []
-    for i in range(len(group1)):
-        for object2 in group2:
-            if group1[i] == object2:
-                found1.insert(0, i)
-                break
-    for j in range(len(group2)):
-        for object1 in group1:
-            if group2[j] == object1:
-                found2.insert(0, j)
-                break
-    for i in found1:
-        del(group1[i])
-    for j in found2:
-        del(group2[j])
-    if len(group1) == 0 and len(group2) == 0:
-        are_same = True
-    else:
-        are_same = False
+    # Objects are compared by identity, so comparing them as sets gives
+    # the same answer as matching them in both directions.
+    are_same = set(list1) == set(list2)
 
     return are_same
 
@@ -2303,23 +2424,26 @@ def analogous_graphs(graph1, graph2):
 
     equi_meshes = []
     if graph1.maxrank == graph2.maxrank:
-        graph2_indexes = list(range(len(graph2.meshes)))
+        # Analogous meshes share the same key. Bucket the indexes of the
+        # meshes from graph2 by key so that each mesh from graph1 takes the
+        # first unused index with its key.
+        buckets = {}
+        for i in range(len(graph2.meshes)):
+            key = analogy_key(graph2.meshes[i], enforcerank=True)
+            if key not in buckets:
+                buckets[key] = collections.deque()
+            buckets[key].append(i)
         all_edges_found = True
         for mesh1 in graph1.meshes:
-            for i in graph2_indexes:
-                mesh2 = graph2.meshes[i]
-                are_equi = analogous_meshes(mesh1, mesh2, enforcerank=True)
-                if are_equi == True:
-                    equi_meshes.append(i)
-                    graph2_indexes.remove(i)
-                    break
-            if are_equi == False:
+            indexes = buckets.get(analogy_key(mesh1, enforcerank=True))
+            if indexes == None or len(indexes) == 0:
                 all_edges_found = False
                 break
+            equi_meshes.append(indexes.popleft())
         # All the edges from graph2 should have been used
         # at this point for both graphs to be equivalent.
         if all_edges_found == True:
-            if len(graph2_indexes) > 0:
+            if len(equi_meshes) < len(graph2.meshes):
                 equi_graphs = False
             else:
                 equi_graphs = True
@@ -2331,6 +2455,41 @@ def analogous_graphs(graph1, graph2):
     return equi_graphs, equi_meshes
 
 
+def analogy_key(mesh, enforcerank=True):
+    """
+    Return a key that is the same for two meshes exactly when
+    analogous_meshes finds them analogous.
+    """
+
+    sources, targets = mesh.get_events()
+    midedge_keys = set()
+    for neighbor in mesh.extend_midedges():
+        midedge_keys.add((neighbor["reltype"],
+                          label_keys(neighbor["srcs"], enforcerank),
+                          label_keys(neighbor["trgs"], enforcerank)))
+    key = (len(mesh.midnodes), len(mesh.midedges),
+           label_keys(sources, enforcerank),
+           label_keys(targets, enforcerank), frozenset(midedge_keys))
+
+    return key
+
+
+def label_keys(nodelist, enforcerank=True):
+    """
+    Return the set of labels, optionally with ranks, of a list of nodes.
+    Two lists of nodes are analogous exactly when their sets are the same.
+    """
+
+    keys = set()
+    for node in nodelist:
+        if enforcerank == True:
+            keys.add((node.label, node.rank))
+        else:
+            keys.add(node.label)
+
+    return frozenset(keys)
+
+
 def analogous_meshes(mesh1, mesh2, enforcerank=True):
     """
     Find whether two meshes connect to event nodes with same labels
@@ -2907,20 +3066,23 @@ def mapcores(eoi, causalgraphs=None, template=None, ignorelist=[],
         meshid = mappedcore.find_max_meshid(cover=True)+1
         maxr = meshedcore.maxrank-1
         # Count the occurrence of every mapped core mesh in the meshed core
-        # and translate the mapped core meshes accordingly.
+        # and translate the mapped core meshes accordingly. Analogous
+        # meshes share the same key, so the meshes are counted by key.
+        core_counts = collections.Counter()
+        for coremesh in meshedcore.meshes:
+            core_counts[analogy_key(coremesh, enforcerank=False)] += 1
         for mappedmesh in mappedcore.meshes:
-            mappedmesh.totcount = 0
-            for coremesh in meshedcore.meshes:
-                if analogous_meshes(coremesh, mappedmesh, enforcerank=False):
-                    mappedmesh.totcount += 1
+            mappedmesh.totcount = core_counts[analogy_key(mappedmesh,
+                                                          enforcerank=False)]
             if mappedmesh.totcount > 1:
                 offset = - (mappedmesh.totcount-1) * transdist / 2
                 translate_mesh(mappedmesh, 1, offset)
+        ccore_counts = collections.Counter()
+        for ccoremesh in meshedcore.covermeshes:
+            ccore_counts[analogy_key(ccoremesh, enforcerank=False)] += 1
         for cmappedmesh in mappedcore.covermeshes:
-            cmappedmesh.totcount = 0
-            for ccoremesh in meshedcore.covermeshes:
-                if analogous_meshes(ccoremesh, cmappedmesh, enforcerank=False):
-                    cmappedmesh.totcount += 1
+            cmappedmesh.totcount = ccore_counts[analogy_key(cmappedmesh,
+                                                            enforcerank=False)]
             if cmappedmesh.totcount > 1:
                 offset = - (cmappedmesh.totcount-1) * transdist / 2
                 translate_mesh(cmappedmesh, 1, offset)
@@ -2948,14 +3110,18 @@ def mapcores(eoi, causalgraphs=None, template=None, ignorelist=[],
         # Map meshes on mapped core template.
         additional_meshes = []
         additional_covermeshes = []
+        mesh_index = analogy_index(mappedcore.meshes)
+        covermesh_index = analogy_index(mappedcore.covermeshes)
         for current_rank in range(maxr+1):
             midid, meshid = mapmesh(meshedcore.meshes,
                                     mappedcore.meshes,
+                                    mesh_index,
                                     additional_meshes,
                                     current_rank, midid, meshid, maxr,
                                     transdist)
             midid, meshid = mapmesh(meshedcore.covermeshes,
                                     mappedcore.covermeshes,
+                                    covermesh_index,
                                     additional_covermeshes,
                                     current_rank, midid, meshid, maxr,
                                     transdist)
@@ -3054,18 +3220,34 @@ def read_layout(eoi, graph, si):
     graph.rankposdict = rankposdict
 
 
-def mapmesh(coremeshes, mapmeshes, add_list, current_rank, midid, meshid,
-            maxr, transdist):
-    """ Map a mesh from meshed core onto the mapped core template. """
+def analogy_index(meshes):
+    """
+    Return a dict giving the indexes of the meshes from a list for each key
+    from analogy_key, ignoring ranks.
+    """
+
+    index = {}
+    for i in range(len(meshes)):
+        key = analogy_key(meshes[i], enforcerank=False)
+        if key not in index:
+            index[key] = []
+        index[key].append(i)
+
+    return index
+
+
+def mapmesh(coremeshes, mapmeshes, mapindex, add_list, current_rank, midid,
+            meshid, maxr, transdist):
+    """
+    Map a mesh from meshed core onto the mapped core template. The mapindex
+    is the analogy_index of mapmeshes.
+    """
 
     for coremesh in coremeshes:
        if coremesh.rank == current_rank:
            # Find analoguous mesh in mapped core template.
-           analog_meshes = []
-           for i in range(len(mapmeshes)):
-               mappedmesh = mapmeshes[i]
-               if analogous_meshes(coremesh, mappedmesh, enforcerank=False):
-                   analog_meshes.append(i)
+           analog_meshes = mapindex.get(analogy_key(coremesh,
+                                                    enforcerank=False), [])
            if len(analog_meshes) != 1:
                raise ValueError("Exactly 1 analogous mesh "
                                 "expected in template.")
@@ -3890,16 +4072,31 @@ def complete_req(graph, mod_nodes):
     for mod_node in mod_nodes:
         if mod_node.intro == False:
             mod_no_intro.append(mod_node)
+    # Upstream paths are shared between mod nodes, so compute the sources
+    # of each node once and memoize the paths found above every node.
+    up_nodes = {}
+    for edge in graph.edges:
+        if edge.target not in up_nodes:
+            up_nodes[edge.target] = []
+        up_nodes[edge.target].append(edge.source)
+    # The paths above a node only depend on the node itself when the graph
+    # has no cycle. Otherwise they also depend on the nodes already visited
+    # on the way up, so they are not memoized.
+    if is_acyclic(up_nodes) == True:
+        paths_cache = {}
+    else:
+        paths_cache = None
+    top_nodes = set(mod_nodes)
     for mod_node in mod_no_intro:
-        top_nodes = []
-        for top_node in mod_nodes:
-            if top_node != mod_node:
-                top_nodes.append(top_node)
-        paths = graph.follow_edges("up", mod_node, top_nodes)
-        all_reqs = []
-        for path in paths:
+        # Gather the reqs of one path at a time and add the new ones to
+        # comp_req_set right away instead of keeping the reqs of all paths.
+        comp_req_set = []
+        seen_reqs = set()
+        for path in upstream_paths(mod_node, top_nodes, up_nodes,
+                                   paths_cache, set()):
             path_reqs = []
-            for i in range(len(path)-1):
+            # The first node of the path is mod_node itself.
+            for i in range(1, len(path)-1):
                 current_node = path[i]
                 #for current_req in current_node.req_species:
                 #    if not species_in(current_req, path_reqs):
@@ -3942,16 +4139,77 @@ def complete_req(graph, mod_nodes):
                                                "bound_site": req_site,
                                                "state": None}
                                     path_reqs.append(partner)
-            all_reqs.append(path_reqs)
-
-        comp_req_set = []
-        for path_reqs in all_reqs:
             for path_req in path_reqs:
-                if not species_in(path_req, comp_req_set):
+                req_key = (path_req["agent"], path_req["site"],
+                           path_req["bound_agent"], path_req["bound_site"],
+                           path_req["state"])
+                if req_key not in seen_reqs:
+                    seen_reqs.add(req_key)
                     comp_req_set.append(path_req)
         mod_node.full_req = comp_req_set
 
 
+def upstream_paths(node, top_nodes, up_nodes, paths_cache, visiting):
+    """
+    Return all the acyclic paths that go up from node to any of the
+    top_nodes, as tuples starting with node. Paths stop at the first top
+    node that they reach. Nodes in visiting are already on the current path
+    and are skipped, so the starting node may itself be in top_nodes. If
+    paths_cache is not None, the paths found above every node are kept in
+    it. It must then only be reused with the same top_nodes, and only for
+    an acyclic graph.
+    """
+
+    if paths_cache != None and node in paths_cache:
+        return paths_cache[node]
+    visiting.add(node)
+    paths = []
+    for up_node in up_nodes.get(node, []):
+        if up_node in visiting:
+            continue
+        if up_node in top_nodes:
+            paths.append((node, up_node))
+        else:
+            for up_path in upstream_paths(up_node, top_nodes, up_nodes,
+                                          paths_cache, visiting):
+                paths.append((node,) + up_path)
+    visiting.remove(node)
+    paths = tuple(paths)
+    if paths_cache != None:
+        paths_cache[node] = paths
+
+    return paths
+
+
+def is_acyclic(up_nodes):
+    """
+    Tell whether the graph given by the list of source nodes of every
+    node has no cycle.
+    """
+
+    # Nodes are "open" while their sources are being explored and "done"
+    # once all the nodes above them were found to be free of cycles.
+    node_states = {}
+    for start_node in up_nodes:
+        if start_node in node_states:
+            continue
+        node_states[start_node] = "open"
+        stack = [(start_node, iter(up_nodes[start_node]))]
+        while len(stack) > 0:
+            node, sources = stack[-1]
+            up_node = next(sources, None)
+            if up_node == None:
+                node_states[node] = "done"
+                stack.pop()
+            elif up_node not in node_states:
+                node_states[up_node] = "open"
+                stack.append((up_node, iter(up_nodes.get(up_node, []))))
+            elif node_states[up_node] == "open":
+                return False
+
+    return True
+
+
 def get_mod_nodes(eoi, graph):
     """ Get modification nodes based on resulting species with state. """
 
@@ -4670,7 +4928,7 @@ def type_bonds2(sites, bond_numbers):
                 new_sites.append(site)
         else:
             new_sites.append(site)
-    sites_set = list(set(new_sites))
+    sites_set = list(dict.fromkeys(new_sites))
     #site_dicts = []
     #for site in sites_set:
     #    site_dict = build_site_dict(site)
@@ -31,6 +31,9 @@ ignorelist = [" unbinds", " ina", " dephos"]
 simtime = 3600
 simseed = None
 
+# Optionally, keep parsed graphs in a cache directory to read them faster.
+#kappapathways.enable_graph_cache("kappapathways-cache")
+
 
 # Run KappaPathways.
 kappapathways.findpathway(eoi, kappamodel, kasimpath, kaflowpath,
@@ -0,0 +1,38 @@
+import kappapathwaysv3
+
+
+def test_upstream_paths_with_cycle():
+    """ Paths found inside a cycle must not depend on the visit order. """
+
+    # Edges d -> b, b -> c, c -> b and c -> a, given as the sources of
+    # every target node. a and d are the top nodes.
+    up_nodes = {"a": ["c"], "b": ["c", "d"], "c": ["b"]}
+    top_nodes = {"a", "d"}
+    assert kappapathwaysv3.is_acyclic(up_nodes) == False
+    paths_cache = None
+    b_paths = kappapathwaysv3.upstream_paths("b", top_nodes, up_nodes,
+                                             paths_cache, set())
+    c_paths = kappapathwaysv3.upstream_paths("c", top_nodes, up_nodes,
+                                             paths_cache, set())
+    assert sorted(b_paths) == [("b", "d")]
+    assert sorted(c_paths) == [("c", "b", "d")]
+    a_paths = kappapathwaysv3.upstream_paths("a", top_nodes, up_nodes,
+                                             paths_cache, set())
+    assert sorted(a_paths) == [("a", "c", "b", "d")]
+
+
+def test_upstream_paths_memoized_on_dag():
+    """ Memoized paths on an acyclic graph match a fresh search. """
+
+    up_nodes = {"a": ["b", "c"], "b": ["d"], "c": ["b", "d"]}
+    top_nodes = {"a", "d"}
+    assert kappapathwaysv3.is_acyclic(up_nodes) == True
+    paths_cache = {}
+    for node in ["c", "b", "a"]:
+        cached = kappapathwaysv3.upstream_paths(node, top_nodes, up_nodes,
+                                                paths_cache, set())
+        fresh = kappapathwaysv3.upstream_paths(node, top_nodes, up_nodes,
+                                               None, set())
+        assert sorted(cached) == sorted(fresh)
+    assert sorted(paths_cache["a"]) == [("a", "b", "d"), ("a", "c", "b", "d"),
+                                        ("a", "c", "d")]